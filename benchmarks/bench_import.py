@@ -0,0 +1,77 @@
+'''
+Import-time check of the core segmentation module.
+
+The module is imported in a fresh interpreter (after numpy, whose import time is reported separately). The check fails
+if the import takes longer than the target or if any of the optional heavy dependencies gets loaded.
+
+usage:
+    python bench_import.py [--target 0.1] [--repeat 5]
+'''
+from __future__ import division
+
+__author__ = 'tomas'
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# seconds allowed for importing the core module on top of numpy
+IMPORT_TIME_TARGET = 0.1
+
+# packages that must not be imported by the core segmentation path
+HEAVY_MODULES = ('matplotlib', 'skimage', 'scipy', 'cv2', 'imtools', 'pygco')
+
+_PROBE = '''
+import json, sys, time
+sys.path.insert(0, %r)
+t_0 = time.time()
+import numpy
+t_1 = time.time()
+import mrfsegmentation.markov_random_field
+t_2 = time.time()
+loaded = sorted(set(m.split('.')[0] for m in sys.modules) & set(%r))
+print(json.dumps({'numpy': t_1 - t_0, 'module': t_2 - t_1, 'loaded': loaded}))
+'''
+
+
+def measure(repeat=5):
+    '''
+    Import the core module in fresh interpreters.
+    :return: dict with the best numpy and module import times and the heavy modules loaded
+    '''
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', _PROBE % (ROOT_DIR, HEAVY_MODULES)])
+        runs.append(json.loads(out.decode().strip().splitlines()[-1]))
+    return {
+        'numpy': min(r['numpy'] for r in runs),
+        'module': min(r['module'] for r in runs),
+        'loaded': sorted(set(m for r in runs for m in r['loaded'])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time check of the core segmentation module.')
+    parser.add_argument('--target', type=float, default=IMPORT_TIME_TARGET)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    res = measure(args.repeat)
+    print('numpy import: %.3f s, module import: %.3f s (target %.3f s)' % (res['numpy'], res['module'], args.target))
+    failed = False
+    if res['module'] > args.target:
+        print('FAILED: the import takes longer than the target')
+        failed = True
+    if res['loaded']:
+        print('FAILED: heavy dependencies imported: %s' % ', '.join(res['loaded']))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
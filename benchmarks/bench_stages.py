@@ -0,0 +1,216 @@
+'''
+Stage-level benchmark of MarkovRandomField.run on synthetic volumes.
+
+Every case is run in a fresh process, the wall time, the cpu time and the growth of the peak resident memory are
+recorded per stage (rescale, model estimation, unaries, pairwise, edge derivation, graph cut) and written to
+a JSON file. Two result files can be compared with --compare.
+
+usage:
+    python bench_stages.py [--preset small|medium|full] [--out results.json] [--compare baseline.json]
+'''
+from __future__ import division
+
+__author__ = 'tomas'
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import concurrent.futures as confut
+import numpy as np
+import scipy.ndimage as scindi
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT_DIR)
+
+# shape, mask fraction, number of classes
+PRESETS = {
+    'small': [
+        ((256, 256), 1.0, 3),
+        ((256, 256), 0.1, 3),
+        ((512, 512), 1.0, 3),
+        ((512, 512), 0.1, 3),
+        ((32, 256, 256), 0.1, 3),
+    ],
+    'medium': [
+        ((512, 512), 1.0, 3),
+        ((512, 512), 0.1, 3),
+        ((64, 512, 512), 1.0, 3),
+        ((64, 512, 512), 0.1, 3),
+        ((128, 512, 512), 0.1, 3),
+    ],
+    'full': [
+        ((256, 256), 1.0, 3),
+        ((512, 512), 1.0, 3),
+        ((128, 512, 512), 0.1, 3),
+        ((256, 512, 512), 0.1, 3),
+        ((512, 512, 512), 0.1, 3),
+        ((512, 512, 512), 0.3, 3),
+    ],
+}
+
+# ratio of the stage times above which a stage is reported as a regression
+REGRESSION_RATIO = 1.2
+# stages slower by less than this many seconds are not reported (timer noise)
+REGRESSION_MIN_TIME = 0.01
+
+
+def synthetic_volume(shape, mask_frac=1.0, n_classes=3, n_seeds=5, dtype=np.int16, random_state=0):
+    '''
+    Create a synthetic volume with a known multi-class intensity distribution.
+    The class regions are obtained by thresholding smoothed noise at its quantiles. Class k has intensities drawn from
+    a normal distribution with the mean 40 + 60 * k and the std 10, the dominant class covers half of the volume.
+    :param shape: 2D or 3D shape of the volume
+    :param mask_frac: fraction of voxels inside the (ellipsoidal) mask
+    :param n_classes: number of intensity classes
+    :param n_seeds: number of seed points per class
+    :return: img, seeds, mask, gt (ground truth class labels 0 .. n_classes - 1)
+    '''
+    rs = np.random.RandomState(random_state)
+    field = scindi.gaussian_filter(rs.randn(*shape).astype(np.float32), sigma=4)
+    # the middle class is dominant (half of the volume), the other classes share the rest equally
+    fracs = np.ones(n_classes) * (0.5 / (n_classes - 1) if n_classes > 1 else 1.)
+    fracs[n_classes // 2] = 0.5 if n_classes > 1 else 1.
+    thresholds = np.percentile(field, 100 * np.cumsum(fracs)[:-1])
+    gt = np.digitize(field, thresholds).astype(np.uint8)
+    del field
+
+    means = 40 + 60 * np.arange(n_classes)
+    img = (means[gt] + 10 * rs.randn(*shape)).astype(dtype)
+
+    # ellipsoid centered in the volume with the requested volume fraction
+    grids = np.ogrid[tuple(slice(0, s) for s in shape)]
+    dist = sum(((g - (s - 1) / 2.) / (s / 2.)) ** 2 for g, s in zip(grids, shape))
+    if mask_frac >= 1:
+        mask = np.ones(shape, dtype=np.uint8)
+    else:
+        mask = (dist <= np.percentile(dist, 100 * mask_frac)).astype(np.uint8)
+
+    seeds = np.zeros(shape, dtype=np.uint8)
+    for k in range(n_classes):
+        pts = np.flatnonzero((gt == k) & (mask > 0))
+        if pts.size:
+            seeds.flat[rs.choice(pts, min(n_seeds, pts.size), replace=False)] = k + 1
+
+    return img, seeds, mask, gt
+
+
+def _maxrss():
+    # peak resident memory of the process in bytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_case(shape, mask_frac, n_classes, scale=0, models_estim='hydohy', repeat=1):
+    '''
+    Segment a synthetic volume, the stages are measured by the instrumentation hooks of MarkovRandomField.
+    '''
+    from mrfsegmentation import instrumentation
+    from mrfsegmentation import markov_random_field as mrf_mod
+
+    params = mrf_mod.MarkovRandomField.load_parameters(os.path.join(ROOT_DIR, 'mrfsegmentation', 'config.ini'))
+    img, seeds, mask, gt = synthetic_volume(shape, mask_frac, n_classes)
+    rss_base = _maxrss()
+
+    collector = instrumentation.StageCollector()
+    for _ in range(repeat):
+        mrf = mrf_mod.MarkovRandomField(img, seeds, mask=mask, n_objects=n_classes, scale=scale,
+                                        models_estim=models_estim, verbose=False, params=params)
+        mrf.add_hook(collector)
+        mrf.run()
+
+    stages = dict((name, {'wall': s['wall'] / repeat, 'cpu': s['cpu'] / repeat, 'peak_rss_delta': s['mem_delta_max']})
+                  for name, s in collector.summary().items())
+    return {
+        'name': '%s_mask%.2f_cls%i_scale%s' % ('x'.join(map(str, shape)), mask_frac, n_classes, scale),
+        'shape': list(shape),
+        'mask_fraction': mask_frac,
+        'n_classes': n_classes,
+        'scale': scale,
+        'repeat': repeat,
+        'n_nodes': int(mrf.nodes.size),
+        'n_edges': int(mrf.edges.shape[0]),
+        'stage_order': collector.order,
+        'stages': stages,
+        'total_wall': sum(s['wall'] for s in stages.values()),
+        'input_bytes': int(img.nbytes),
+        'peak_rss': _maxrss(),
+        'peak_rss_growth': _maxrss() - rss_base,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    '''
+    Compare the stage times of two result sets, return the list of regressions.
+    '''
+    base_cases = dict((c['name'], c) for c in baseline['cases'])
+    regressions = []
+    for case in results['cases']:
+        base = base_cases.get(case['name'])
+        if base is None:
+            continue
+        for name in case['stage_order']:
+            if name not in base['stages']:
+                continue
+            t_new = case['stages'][name]['wall']
+            t_old = base['stages'][name]['wall']
+            ratio = t_new / t_old if t_old > 0 else float('inf')
+            print('%-40s %-10s %8.3fs -> %8.3fs  (x%.2f)' % (case['name'], name, t_old, t_new, ratio))
+            if ratio > REGRESSION_RATIO and t_new - t_old > REGRESSION_MIN_TIME:
+                regressions.append((case['name'], name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stage-level benchmark of the MRF segmentation.')
+    parser.add_argument('--preset', default='small', choices=sorted(PRESETS.keys()))
+    parser.add_argument('--scale', type=float, default=0)
+    parser.add_argument('--models', default='hydohy', help='model estimation mode')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--compare', default=None, help='baseline results to compare with')
+    args = parser.parse_args()
+
+    results = {
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'cases': [],
+    }
+    for shape, mask_frac, n_classes in PRESETS[args.preset]:
+        # a fresh process per case so that the peak memory of one case does not hide the others
+        with confut.ProcessPoolExecutor(max_workers=1) as executor:
+            case = executor.submit(run_case, shape, mask_frac, n_classes, args.scale, args.models,
+                                   args.repeat).result()
+        results['cases'].append(case)
+        print('%-40s total %8.3fs, nodes %10i, edges %10i, peak rss %8.1f MB' % (
+            case['name'], case['total_wall'], case['n_nodes'], case['n_edges'], case['peak_rss'] / 2. ** 20))
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        for case_name, stage, ratio in regressions:
+            print('REGRESSION: %s / %s is %.2fx slower' % (case_name, stage, ratio))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
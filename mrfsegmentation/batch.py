@@ -0,0 +1,87 @@
+__author__ = 'tomas'
+
+import multiprocessing
+import time
+import traceback
+from collections import namedtuple
+
+import concurrent.futures as confut
+
+from markov_random_field import MarkovRandomField
+
+# arguments of MarkovRandomField.__init__ that may be passed in the parameters of a job
+MRF_ARGS = ('n_objects', 'alpha', 'beta', 'scale', 'models_estim')
+
+# result of a single job - labels is None and error contains the formatted traceback if the job failed
+BatchResult = namedtuple('BatchResult', ['job_id', 'labels', 'error', 'time'])
+
+
+def _segment_job(job_id, img, seeds, mask, params):
+    # runs in a worker process, exceptions are returned as text so that a failing job does not break the pool
+    t_start = time.time()
+    try:
+        kwargs = dict((k, params[k]) for k in MRF_ARGS if k in params)
+        mrf = MarkovRandomField(img, seeds, mask=mask, verbose=False, params=params, **kwargs)
+        labels = mrf.run()
+        return BatchResult(job_id, labels, None, time.time() - t_start)
+    except Exception:
+        return BatchResult(job_id, None, traceback.format_exc(), time.time() - t_start)
+
+
+def _unpack_job(job):
+    # a job is (img, seeds, mask, params) where the trailing items may be omitted
+    job = tuple(job) + (None,) * (4 - len(job))
+    return job[:4]
+
+
+def segment_batch(jobs, max_workers=None, max_in_flight=None, params=None, config_path='config.ini'):
+    '''
+    Segment many volumes in a process pool.
+    The parameters are parsed once in the calling process and shipped to the workers together with every job. The
+    jobs are consumed lazily and at most max_in_flight of them are submitted at once so that the memory stays capped.
+    :param jobs: iterable of tuples (img, seeds, mask, params), params is a dict of per-job parameters overriding the
+                 common ones (it can contain the arguments of MarkovRandomField, e.g. alpha, beta or models_estim)
+    :param max_workers: number of worker processes, defaults to the number of cpus
+    :param max_in_flight: maximal number of submitted and unfinished jobs, defaults to 2 * max_workers
+    :param params: common parameters, loaded from config_path if not given
+    :param config_path: path to the config file
+    :return: generator of BatchResult in the order of completion
+    '''
+    if params is None:
+        params = MarkovRandomField.load_parameters(config_path)
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+
+    jobs = enumerate(jobs)
+    pending = dict()
+    exhausted = False
+    with confut.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                try:
+                    job_id, job = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                img, seeds, mask, job_params = _unpack_job(job)
+                p = dict(params)
+                if job_params is not None:
+                    p.update(job_params)
+                future = executor.submit(_segment_job, job_id, img, seeds, mask, p)
+                pending[future] = job_id
+                del img, seeds, mask
+
+            if not pending:
+                break
+
+            done, _ = confut.wait(pending, return_when=confut.FIRST_COMPLETED)
+            for future in done:
+                job_id = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    # the worker itself died (e.g. killed by the system)
+                    result = BatchResult(job_id, None, traceback.format_exc(), None)
+                yield result
@@ -0,0 +1,206 @@
+'''
+Headless batch segmentation of volumes.
+
+The cases are the volumes of a directory (seeds and masks are found by the suffixes of their names) or the rows of a
+CSV manifest with the columns case, image, seeds, mask (seeds and mask may be empty). The volumes are memory-mapped,
+the parameters are read from the config file and overridden by --set flags. The labels are written bit-packed or as
+memory-mapped .npy files and the timings of every case are recorded in a summary CSV file.
+
+usage:
+    python cli.py INPUT OUTPUT_DIR [--config config.ini] [--set alpha=2 --set scale=0.5] [--format packed]
+'''
+__author__ = 'tomas'
+
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import instrumentation
+import volume_io
+from markov_random_field import MarkovRandomField
+from session import Segmenter
+
+VOLUME_EXTS = ('.npy', '.npz', '.raw')
+
+
+def parse_value(value):
+    # the same conversion as load_parameters - int, float or string
+    for conv in (int, float):
+        try:
+            return conv(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_overrides(items):
+    '''
+    :param items: list of 'name=value' strings
+    :return: dict of parsed values
+    '''
+    params = dict()
+    for item in items or []:
+        if '=' not in item:
+            raise ValueError('Parameter override has to be name=value: %s' % item)
+        name, value = item.split('=', 1)
+        params[name.strip()] = parse_value(value.strip())
+    return params
+
+
+def _case_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def directory_cases(dir_path, seeds_suffix='_seeds', mask_suffix='_mask'):
+    '''
+    Cases of a directory - every volume not ending with a seeds or mask suffix is an image.
+    :return: list of (case, image, seeds, mask) - seeds and mask are None if there is no such file
+    '''
+    files = sorted(p for p in glob.glob(os.path.join(dir_path, '*')) if os.path.splitext(p)[1].lower() in VOLUME_EXTS)
+    by_name = dict((_case_name(p), p) for p in files)
+    cases = []
+    for path in files:
+        name = _case_name(path)
+        if name.endswith(seeds_suffix) or name.endswith(mask_suffix):
+            continue
+        cases.append((name, path, by_name.get(name + seeds_suffix), by_name.get(name + mask_suffix)))
+    return cases
+
+
+def manifest_cases(manifest_path):
+    '''
+    Cases of a CSV manifest with the columns case, image, seeds, mask, relative paths are relative to the manifest.
+    :return: list of (case, image, seeds, mask)
+    '''
+    base = os.path.dirname(os.path.abspath(manifest_path))
+
+    def resolve(path):
+        if not path:
+            return None
+        return path if os.path.isabs(path) else os.path.join(base, path)
+
+    cases = []
+    with open(manifest_path) as f:
+        for row in csv.DictReader(f):
+            image = resolve(row['image'])
+            cases.append((row.get('case') or _case_name(image), image, resolve(row.get('seeds')),
+                          resolve(row.get('mask'))))
+    return cases
+
+
+class _CaseTimer():
+    # hook recording the wall time of the stages of the current case
+
+    def __init__(self):
+        self.times = dict()
+
+    def __call__(self, event):
+        if event.phase == 'end':
+            self.times[event.stage] = self.times.get(event.stage, 0) + event.wall
+
+
+def segment_cases(cases, out_dir, params, fmt='packed', raw_shape=None, raw_dtype=None, n_objects=2,
+                  models_estim=None, summary_path=None, verbose=False):
+    '''
+    Segment the cases one by one with a shared segmentation session.
+    :param cases: list of (case, image, seeds, mask) paths
+    :param out_dir: output directory of the labels
+    :param params: parsed parameters
+    :param fmt: format of the labels, see volume_io.save_labels
+    :param summary_path: CSV file of the per-case timings, defaults to out_dir/summary.csv
+    :return: list of summary rows (dicts)
+    '''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if summary_path is None:
+        summary_path = os.path.join(out_dir, 'summary.csv')
+    # the session works in the lean mode, the memory-mapped inputs are never copied
+    segmenter = Segmenter(params=params, n_objects=n_objects, models_estim=models_estim)
+    timer = _CaseTimer()
+    segmenter.add_hook(timer)
+
+    def load(path):
+        if path is None:
+            return None
+        return volume_io.load_volume(path, shape=raw_shape, dtype=raw_dtype)
+
+    rows = []
+    for case, image, seeds, mask in cases:
+        timer.times = dict()
+        row = {'case': case, 'status': 'ok', 'error': ''}
+        t_start = time.time()
+        try:
+            img = load(image)
+            row['shape'] = 'x'.join(str(s) for s in img.shape)
+            row['time_load'] = time.time() - t_start
+            labels = segmenter.segment(img, load(seeds), load(mask))
+            t_save = time.time()
+            row['output'] = volume_io.save_labels(os.path.join(out_dir, case + '_labels'), labels, fmt=fmt)
+            row['time_save'] = time.time() - t_save
+            row['energy'] = segmenter.last.energy
+        except Exception:
+            row['status'] = 'failed'
+            row['error'] = traceback.format_exc().strip().splitlines()[-1]
+            if verbose:
+                traceback.print_exc()
+        row.update(('time_%s' % k, v) for k, v in timer.times.items())
+        row['time_total'] = time.time() - t_start
+        rows.append(row)
+        if verbose:
+            print '%s: %s (%.3f s)' % (case, row['status'], row['time_total'])
+
+    fields = ['case', 'status', 'shape', 'output', 'energy', 'time_total', 'time_load', 'time_save']
+    fields += sorted(set(k for r in rows for k in r) - set(fields) - {'error'}) + ['error']
+    with open(summary_path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless batch segmentation of volumes.')
+    parser.add_argument('input', help='directory of volumes or a CSV manifest (case, image, seeds, mask)')
+    parser.add_argument('output', help='output directory of the labels and of the summary')
+    parser.add_argument('--config', default='config.ini', help='config file of the parameters')
+    parser.add_argument('--set', action='append', metavar='NAME=VALUE', help='override a parameter of the config')
+    parser.add_argument('--format', default='packed', choices=['packed', 'memmap'], help='format of the labels')
+    parser.add_argument('--n-objects', type=int, default=2, help='number of objects segmented without seeds')
+    parser.add_argument('--models-estim', default=None, help='seeds, hydohy or n_objects (default by the seeds)')
+    parser.add_argument('--seeds-suffix', default='_seeds')
+    parser.add_argument('--mask-suffix', default='_mask')
+    parser.add_argument('--raw-shape', default=None, help='shape of raw volumes, e.g. 300,512,512')
+    parser.add_argument('--raw-dtype', default='int16', help='dtype of raw volumes')
+    parser.add_argument('--summary', default=None, help='summary CSV file, defaults to OUTPUT/summary.csv')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    params = MarkovRandomField.load_parameters(args.config)
+    params.update(parse_overrides(args.set))
+    raw_shape = tuple(int(s) for s in args.raw_shape.split(',')) if args.raw_shape else None
+
+    if os.path.isdir(args.input):
+        cases = directory_cases(args.input, args.seeds_suffix, args.mask_suffix)
+    else:
+        cases = manifest_cases(args.input)
+
+    if args.verbose:
+        instrumentation.register_hook(instrumentation.print_hook)
+    rows = segment_cases(cases, args.output, params, fmt=args.format, raw_shape=raw_shape,
+                         raw_dtype=np.dtype(args.raw_dtype), n_objects=args.n_objects,
+                         models_estim=args.models_estim, summary_path=args.summary, verbose=args.verbose)
+    n_failed = sum(r['status'] != 'ok' for r in rows)
+    print '%i cases segmented, %i failed' % (len(rows) - n_failed, n_failed)
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
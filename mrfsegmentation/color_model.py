@@ -1,7 +1,117 @@
 from __future__ import division
 
 import numpy as np
-import scipy.stats as scista
+
+# maximal number of table entries, inputs with a wider intensity range are evaluated directly
+LUT_MAX_SIZE = 2 ** 17
+
+# number of voxels converted to table indices at once
+LUT_CHUNK = 2 ** 20
+
+
+class IntensityLUT():
+    '''
+    Mapping of image intensities to indices of a lookup table.
+    Integer images are indexed directly by their (offset) intensities, float images have to be quantised - the
+    quantisation is opt-in through the quant_step parameter.
+    '''
+
+    def __init__(self, img, quant_step=None, basis=None):
+        '''
+        :param img: image to index
+        :param quant_step: quantisation step of float images
+        :param basis: LUT whose intensities (range, quantisation and present values) are shared, e.g. that of a whole
+                      volume by the LUTs of its slabs (see of_parts) - the image has to lie within its range
+        '''
+        img = np.asarray(img)
+        self.shape = img.shape
+        self.basis = basis
+        if basis is None:
+            self._set_range(img.min(), img.max(), img.dtype, quant_step)
+        else:
+            self.lo, self.quant_step, self.x = basis.lo, basis.quant_step, basis.x
+            if img.size and (img.min() < self.lo or self._index_of(img.max()) >= self.x.size):
+                raise ValueError('Image intensities outside the range of the lookup table.')
+        self.idx = self._index(img)
+        if basis is None:
+            # the normalisations are done over the intensities actually present in the image
+            self.present = np.bincount(self.idx, minlength=self.x.size) > 0
+        else:
+            self.present = basis.present
+
+    @classmethod
+    def of_parts(cls, parts, quant_step=None):
+        '''
+        Intensities of the lookup table of a volume given by its parts (e.g. slabs), the volume is never indexed as a
+        whole. The result has no indices and serves as the basis of the LUTs of the parts.
+        :param parts: callable returning a new iterable of the parts on every call, the parts are passed twice
+        :return: IntensityLUT with idx None
+        '''
+        lo = hi = dtype = None
+        for part in parts():
+            part = np.asarray(part)
+            if part.size:
+                lo = part.min() if lo is None else min(lo, part.min())
+                hi = part.max() if hi is None else max(hi, part.max())
+                dtype = part.dtype
+        if dtype is None:
+            raise ValueError('No intensities to tabulate.')
+        # the range is set up by the LUT of the extreme intensities
+        lut = cls(np.array([lo, hi], dtype=dtype), quant_step=quant_step)
+        lut.shape = None
+        lut.idx = None
+        lut.present = np.zeros(lut.x.size, dtype=np.bool_)
+        for part in parts():
+            lut.present |= np.bincount(lut._index(np.asarray(part)), minlength=lut.x.size) > 0
+        return lut
+
+    def _set_range(self, lo, hi, dtype, quant_step):
+        self.lo = lo
+        self.quant_step = quant_step
+        if np.issubdtype(dtype, np.integer) or dtype == np.bool_:
+            self.quant_step = None
+            n_values = int(hi) - int(self.lo) + 1
+            self.x = np.arange(int(self.lo), int(hi) + 1)
+        elif quant_step:
+            # the intensities are rounded to the nearest step (the maximum may round up to the next one) with the same
+            # arithmetic as the indices below
+            n_values = self._index_of(hi) + 1
+            self.x = self.lo + quant_step * np.arange(n_values)
+        else:
+            raise ValueError('Float images can be tabulated only with a quantisation step.')
+        if n_values > LUT_MAX_SIZE:
+            raise ValueError('Intensity range too wide for a lookup table (%i values).' % n_values)
+
+    def _index_of(self, value):
+        # table index of one intensity
+        if self.quant_step is None:
+            return int(value) - int(self.lo)
+        return int(np.round((np.asarray([value]) - self.lo) / self.quant_step)[0])
+
+    def _index(self, img):
+        n_values = self.x.size
+        idx_dtype = np.uint8 if n_values <= 256 else (np.uint16 if n_values <= 65536 else np.int32)
+        # the indices are computed in chunks so that no full-size wide temporary is allocated
+        flat = img.reshape(-1)
+        idx = np.empty(flat.size, dtype=idx_dtype)
+        for start in range(0, flat.size, LUT_CHUNK):
+            chunk = flat[start:start + LUT_CHUNK]
+            if self.quant_step is None:
+                # the subtraction is done in a wider type so that the full range of e.g. int16 does not overflow
+                wide_dtype = np.int32 if img.dtype.itemsize <= 2 else np.int64
+                idx[start:start + LUT_CHUNK] = np.subtract(chunk, self.lo, dtype=wide_dtype)
+            else:
+                idx[start:start + LUT_CHUNK] = np.round((chunk - self.lo) / self.quant_step)
+        return idx
+
+    def gather(self, table):
+        '''
+        Evaluate the table on the image.
+        :param table: 1D table (n_values,) or stacked tables (n_values, n_objects)
+        :return: raveled values (n_pts,) or (n_pts, n_objects)
+        '''
+        return table[self.idx]
+
 
 class ColorModel():
 
@@ -9,15 +119,37 @@ class ColorModel():
         # self.x = x
         self.mean = mean
         self.sigma = sigma
-        self.rv = scista.norm(self.mean, self.sigma)
+        self.type = type
+        # the normal distribution is evaluated by numpy, scipy is imported only for the cdf and sf models
         if type == 'pdf':
-            self.prob_func = scista.norm(self.mean, self.sigma).pdf
+            self.prob_func = self.pdf
         elif type == 'cdf':
-            self.prob_func = scista.norm(self.mean, self.sigma).cdf
+            self.prob_func = self.cdf
         elif type == 'sf':
-            self.prob_func = scista.norm(self.mean, self.sigma).sf
+            self.prob_func = self.sf
         self.max_val = max_val
 
+    @property
+    def rv(self):
+        import scipy.stats as scista
+        return scista.norm(self.mean, self.sigma)
+
+    def pdf(self, x):
+        # evaluated in float64, the difference of unsigned intensities would wrap around
+        x = np.asarray(x, dtype=np.float64)
+        z = (x - self.mean) / self.sigma
+        return np.exp(-z ** 2 / 2.) / (np.sqrt(2 * np.pi) * self.sigma)
+
+    def cdf(self, x):
+        from scipy.special import ndtr
+        x = np.asarray(x, dtype=np.float64)
+        return ndtr((x - self.mean) / self.sigma)
+
+    def sf(self, x):
+        from scipy.special import ndtr
+        x = np.asarray(x, dtype=np.float64)
+        return ndtr((self.mean - x) / self.sigma)
+
     def get_val(self, x):
         y = self.prob_func(x)
         if self.max_val is not None:
@@ -25,19 +157,19 @@ class ColorModel():
         return y
 
     def get_pdf(self, x):
-        y =self.rv.pdf(x)
+        y = self.pdf(x)
         if self.max_val is not None:
             y = y / y.max() * self.max_val
         return y
 
     def get_cdf(self, x):
-        y =self.rv.cdf(x)
+        y = self.cdf(x)
         if self.max_val is not None:
             y = y / y.max() * self.max_val
         return y
 
     def get_sf(self, x):
-        y =self.rv.sf(x)
+        y = self.sf(x)
         if self.max_val is not None:
             y = y / y.max() * self.max_val
         return y
@@ -59,3 +191,47 @@ class ColorModel():
         y = self.get_val(x)
         y = y.max() - y
         return y
+
+    def get_val_lut(self, lut):
+        # get_val tabulated over the intensities of the lut, the max_val normalisation is done at table level
+        y = self.prob_func(lut.x)
+        if self.max_val is not None:
+            y = y / y[lut.present].max() * self.max_val
+        return y
+
+    def get_inverse_lut(self, lut, rescale=False):
+        '''
+        Tabulated equivalent of get_inverse.
+        :param lut: IntensityLUT of the image
+        :param rescale: if to linearly rescale the table to [0, 255] as skimage.exposure.rescale_intensity does
+        :return: table of shape (n_values,)
+        '''
+        y = self.get_val_lut(lut)
+        y = y[lut.present].max() - y
+        if rescale:
+            y_min = y[lut.present].min()
+            y_max = y[lut.present].max()
+            y = np.clip(y, y_min, y_max)
+            y = (y - y_min) / float(y_max - y_min) * 255
+        return y
+
+
+def pack_models(models):
+    '''
+    Parameters of models as arrays that can be stored with np.savez.
+    :return: (values, types) - float64 (n_models, 3) array of mean, sigma and max_val (nan for None) and an array of
+             the model types
+    '''
+    values = np.array([(m.mean, m.sigma, np.nan if m.max_val is None else m.max_val) for m in models],
+                      dtype=np.float64).reshape(-1, 3)
+    types = np.array([m.type for m in models])
+    return values, types
+
+
+def unpack_models(values, types):
+    '''
+    Inverse of pack_models.
+    :return: list of ColorModels
+    '''
+    return [ColorModel(mean, sigma, type=str(t), max_val=None if np.isnan(max_val) else max_val)
+            for (mean, sigma, max_val), t in zip(values, types)]
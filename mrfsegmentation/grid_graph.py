@@ -0,0 +1,155 @@
+__author__ = 'tomas'
+
+import numpy as np
+
+
+def _axis_slices(ndim, axis):
+    # slices selecting the 'first' and 'second' node of every edge along the given axis
+    sl_a = [slice(None)] * ndim
+    sl_b = [slice(None)] * ndim
+    sl_a[axis] = slice(None, -1)
+    sl_b[axis] = slice(1, None)
+    return tuple(sl_a), tuple(sl_b)
+
+
+def mask_node_ids(mask):
+    '''
+    Renumber the voxels inside the mask.
+    :param mask: boolean (or nonzero-valued) array
+    :return: (node_ids, flat_inds) - node_ids has the shape of the mask and contains consecutive ids of in-mask voxels
+             and -1 elsewhere, flat_inds are the raveled indices of the in-mask voxels in the order of their ids
+    '''
+    mask = np.asarray(mask) != 0
+    flat_inds = np.flatnonzero(mask)
+    node_ids = np.empty(mask.shape, dtype=np.int32)
+    node_ids.fill(-1)
+    node_ids.flat[flat_inds] = np.arange(flat_inds.size, dtype=np.int32)
+    return node_ids, flat_inds
+
+
+def connectivity_axes(ndim, connectivity=None):
+    '''
+    Axes along which the grid nodes are connected, in the order of the edges (horizontal, vertical, depth).
+    :param connectivity: 4 (in-plane only) or 6 (3D), None = full connectivity of the grid
+    '''
+    if connectivity is None or connectivity == 2 * ndim:
+        return list(range(ndim - 1, -1, -1))
+    if connectivity == 4:
+        return [ndim - 1, ndim - 2]
+    raise ValueError('Unsupported connectivity: %s' % connectivity)
+
+
+def masked_grid_edges(mask, connectivity=None):
+    '''
+    Derive the grid edges of the in-mask voxels only.
+    Neighbours are found by shifting the boolean mask along every axis, i.e. 4-connectivity in 2D and 6-connectivity
+    in 3D. Edges are ordered as horizontal, vertical and (in 3D) depth edges and reference the compacted node ids.
+    :param mask: 2D or 3D boolean (or nonzero-valued) array
+    :param connectivity: 4 to connect 3D grids in-plane only, None = full connectivity
+    :return: (edges, flat_inds) - edges is an (n_edges, 2) int32 array, flat_inds are the raveled indices of the nodes
+    '''
+    mask = np.asarray(mask) != 0
+    if mask.ndim not in (2, 3):
+        raise ValueError('Only 2D and 3D grids are supported.')
+    node_ids, flat_inds = mask_node_ids(mask)
+
+    edges_l = []
+    for axis in connectivity_axes(mask.ndim, connectivity):
+        sl_a, sl_b = _axis_slices(mask.ndim, axis)
+        both = mask[sl_a] & mask[sl_b]
+        edges_l.append(np.c_[node_ids[sl_a][both], node_ids[sl_b][both]])
+    edges = np.vstack(edges_l).astype(np.int32)
+
+    return edges, flat_inds
+
+
+def scatter_labels(labels_in, flat_inds, shape, bgd_label=0, dtype=None, out=None):
+    '''
+    Scatter labels of the compacted nodes back to a full-size array.
+    :param labels_in: labels of the in-mask nodes
+    :param flat_inds: raveled indices of the nodes (as returned by masked_grid_edges)
+    :param shape: shape of the output array
+    :param bgd_label: label assigned to voxels outside the mask
+    :param out: optional preallocated output array
+    :return: labels of the shape 'shape'
+    '''
+    if dtype is None:
+        dtype = np.asarray(labels_in).dtype
+    labels = np.empty(shape, dtype=dtype) if out is None else out
+    labels.fill(bgd_label)
+    labels.flat[flat_inds] = labels_in
+    return labels
+
+
+def node_parity(flat_inds, shape):
+    '''
+    Checkerboard coloring of grid nodes - the parity of the sum of their coordinates.
+    Neighbouring grid nodes always have different parity.
+    :param flat_inds: raveled indices of the nodes
+    :param shape: shape of the grid
+    :return: array of 0/1 colors
+    '''
+    coords = np.unravel_index(flat_inds, shape)
+    parity = np.zeros(len(flat_inds), dtype=np.uint8)
+    for c in coords:
+        parity ^= (c & 1).astype(np.uint8)
+    return parity
+
+
+def boundary_band(labels, mask, width, axes=None):
+    '''
+    Band of voxels around the boundaries between labels inside the mask.
+    The voxels with a differently labelled neighbour are dilated by width voxels along the given axes (a box of the
+    half-width width).
+    :param labels: labels of the grid
+    :param mask: boolean (or nonzero-valued) array, boundaries with the voxels outside the mask are ignored
+    :param width: half-width of the band
+    :param axes: axes of the dilation, defaults to all the axes
+    :return: boolean band restricted to the mask
+    '''
+    mask = np.asarray(mask) != 0
+    band = np.zeros(labels.shape, dtype=np.bool_)
+    for axis in range(labels.ndim):
+        sl_a, sl_b = _axis_slices(labels.ndim, axis)
+        diff = (labels[sl_a] != labels[sl_b]) & mask[sl_a] & mask[sl_b]
+        band[sl_a] |= diff
+        band[sl_b] |= diff
+    if axes is None:
+        axes = range(labels.ndim)
+    for axis in axes:
+        # separable dilation - the band is shifted by 1 .. width voxels in both directions along the axis
+        grown = band.copy()
+        for shift in range(1, min(width, labels.shape[axis] - 1) + 1):
+            sl_a, sl_b = _axis_slices(labels.ndim, axis)
+            sl_a = list(sl_a)
+            sl_b = list(sl_b)
+            sl_a[axis] = slice(None, -shift)
+            sl_b[axis] = slice(shift, None)
+            grown[tuple(sl_a)] |= band[tuple(sl_b)]
+            grown[tuple(sl_b)] |= band[tuple(sl_a)]
+        band = grown
+    return band & mask
+
+
+def fixed_neighbour_costs(free, fixed, labels, node_ids, pairwise, n_nodes):
+    '''
+    Pairwise costs between the free nodes and their neighbours with fixed labels, folded into unaries.
+    :param free: boolean array of the free voxels (graph nodes)
+    :param fixed: boolean array of the voxels with fixed labels
+    :param labels: labels of the grid, those of the fixed voxels are used
+    :param node_ids: ids of the free voxels as returned by mask_node_ids
+    :param pairwise: (n_labels, n_labels) symmetric pairwise costs
+    :param n_nodes: number of the free nodes
+    :return: (n_nodes, n_labels) costs to be added to the unaries of the free nodes
+    '''
+    n_labels = pairwise.shape[0]
+    costs = np.zeros((n_nodes, n_labels), dtype=np.int64)
+    for axis in range(free.ndim):
+        sl_a, sl_b = _axis_slices(free.ndim, axis)
+        for sl_free, sl_fixed in ((sl_a, sl_b), (sl_b, sl_a)):
+            sel = free[sl_free] & fixed[sl_fixed]
+            ids = node_ids[sl_free][sel]
+            fixed_labels = labels[sl_fixed][sel]
+            for k in range(n_labels):
+                costs[:, k] += np.bincount(ids, weights=pairwise[k][fixed_labels], minlength=n_nodes).astype(np.int64)
+    return costs
@@ -0,0 +1,226 @@
+from __future__ import division
+
+__author__ = 'tomas'
+
+import numpy as np
+
+# number of slices processed at once when streaming over the volume
+CHUNK_SLICES = 8
+
+# float images are binned this many times finer than requested so that the moments are accurate
+FLOAT_BIN_REFINE = 16
+
+
+def _chunks(img, mask, subsample=1):
+    # (intensities, mask) of consecutive slabs of slices, optionally subsampled along every axis
+    step = max(1, int(subsample))
+    for start in range(0, img.shape[0], CHUNK_SLICES * step):
+        sl = (slice(start, start + CHUNK_SLICES * step, step),) + (slice(None, None, step),) * (img.ndim - 1)
+        chunk = np.asarray(img[sl])
+        chunk_mask = np.asarray(mask[sl]) != 0 if mask is not None else None
+        yield chunk, chunk_mask
+
+
+def _masked_values(chunk, chunk_mask):
+    if chunk_mask is None:
+        return chunk.ravel()
+    return chunk[chunk_mask]
+
+
+def _masked_range(img, mask, subsample=1):
+    v_min = None
+    v_max = None
+    for chunk, chunk_mask in _chunks(img, mask, subsample):
+        vals = _masked_values(chunk, chunk_mask)
+        if vals.size == 0:
+            continue
+        v_min = vals.min() if v_min is None else min(v_min, vals.min())
+        v_max = vals.max() if v_max is None else max(v_max, vals.max())
+    return v_min, v_max
+
+
+def masked_histogram(img, mask=None, nbins=256, subsample=1):
+    '''
+    Histogram of the intensities inside the mask, computed by streaming over slabs of slices.
+    Integer images have one bin per intensity (as skimage.exposure.histogram), 8 and 16 bit images are processed in a
+    single pass. Float images are binned into nbins bins, the range is found in an additional pass.
+    :param img: 3D image, can be a np.memmap
+    :param mask: mask of the same shape, None = whole image
+    :param nbins: number of bins of float images
+    :param subsample: only every subsample-th voxel along every axis is used
+    :return: hist, bin_centers - the histogram is clipped to start and end with a non-zero bin
+    '''
+    if np.issubdtype(img.dtype, np.integer) and img.dtype.itemsize <= 2:
+        offset = np.iinfo(img.dtype).min
+        hist = np.zeros(2 ** (8 * img.dtype.itemsize), dtype=np.int64)
+        for chunk, chunk_mask in _chunks(img, mask, subsample):
+            vals = _masked_values(chunk, chunk_mask).astype(np.int32)
+            hist += np.bincount(vals - offset, minlength=hist.size)
+        centers = np.arange(hist.size) + offset
+    elif np.issubdtype(img.dtype, np.integer):
+        v_min, v_max = _masked_range(img, mask, subsample)
+        if v_min is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        hist = np.zeros(int(v_max) - int(v_min) + 1, dtype=np.int64)
+        for chunk, chunk_mask in _chunks(img, mask, subsample):
+            vals = _masked_values(chunk, chunk_mask).astype(np.int64)
+            hist += np.bincount(vals - int(v_min), minlength=hist.size)
+        centers = np.arange(hist.size) + int(v_min)
+    else:
+        v_min, v_max = _masked_range(img, mask, subsample)
+        if v_min is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        hist = np.zeros(nbins, dtype=np.int64)
+        for chunk, chunk_mask in _chunks(img, mask, subsample):
+            h, edges = np.histogram(_masked_values(chunk, chunk_mask), bins=nbins, range=(v_min, v_max))
+            hist += h
+        edges = np.linspace(v_min, v_max, nbins + 1)
+        centers = (edges[:-1] + edges[1:]) / 2.
+        return hist, centers
+
+    nonzero = np.flatnonzero(hist)
+    if nonzero.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    return hist[nonzero[0]:nonzero[-1] + 1], centers[nonzero[0]:nonzero[-1] + 1]
+
+
+def coarsen(hist, centers, factor):
+    '''
+    Merge every factor consecutive bins of a histogram.
+    :return: hist, bin_centers
+    '''
+    n = hist.size // factor * factor
+    hist = hist[:n].reshape(-1, factor).sum(axis=1)
+    centers = centers[:n].reshape(-1, factor).mean(axis=1)
+    return hist, centers
+
+
+def hist_moments(hist, x, sel=None):
+    '''
+    Mean and standard deviation of the values represented by a histogram (the same as scipy.stats.norm.fit).
+    :param hist: histogram counts
+    :param x: values (bin centers)
+    :param sel: optional boolean selection of bins
+    :return: mean, std - (nan, nan) if the selection is empty
+    '''
+    if sel is not None:
+        hist = hist[sel]
+        x = x[sel]
+    n = hist.sum()
+    if n == 0:
+        return np.nan, np.nan
+    mean = (hist * x).sum() / n
+    var = (hist * (x - mean) ** 2).sum() / n
+    return mean, np.sqrt(var)
+
+
+def peak_window(hist, peak_idx, n_target):
+    '''
+    Find the smallest half-width w of the window [peak_idx - w, peak_idx + w) around the peak containing at least
+    n_target counts. The counts of all the windows are obtained from the cumulative sum at once.
+    :return: half-width of the window
+    '''
+    if hist[peak_idx] >= n_target:
+        return 0
+    cum = np.concatenate(([0], np.cumsum(hist)))
+    n = hist.size
+    widths = np.arange(1, n + 1)
+    n_in = cum[np.minimum(peak_idx + widths, n)] - cum[np.maximum(peak_idx - widths, 0)]
+    idx = np.searchsorted(n_in, n_target)
+    return widths[min(idx, n - 1)]
+
+
+def _normal_pdf(x, mean, sigma):
+    return np.exp(-0.5 * ((x - mean) / sigma) ** 2) / (np.sqrt(2 * np.pi) * sigma)
+
+
+def gmm_em(hist, x, n_components, n_iter=100, tol=1e-6, min_sigma=None):
+    '''
+    Gaussian mixture fitted to a histogram by expectation-maximization.
+    The counts act as weights of the bin centers, one iteration costs O(n_bins * n_components) independently of the
+    number of voxels. The components are initialized at the quantiles of the histogram.
+    :param hist: histogram counts
+    :param x: bin centers
+    :param n_components: number of the gaussians
+    :param n_iter: maximal number of iterations
+    :param tol: the iteration stops when the mean log-likelihood improves by less than tol
+    :param min_sigma: lower bound of the standard deviations, defaults to the bin width
+    :return: weights, means, sigmas - sorted by the means
+    '''
+    hist = np.asarray(hist, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    n = hist.sum()
+    if n == 0:
+        raise ValueError('Cannot fit a mixture to an empty histogram.')
+    if min_sigma is None:
+        min_sigma = (x[-1] - x[0]) / max(1, x.size - 1) if x.size > 1 else 1.
+        min_sigma = max(min_sigma, 1e-6)
+
+    # initialization - the components split the histogram mass evenly
+    cum = np.cumsum(hist) / n
+    bounds = np.searchsorted(cum, np.arange(1, n_components) / n_components)
+    parts = np.split(np.arange(x.size), bounds)
+    weights = np.empty(n_components)
+    means = np.empty(n_components)
+    sigmas = np.empty(n_components)
+    _, sigma_all = hist_moments(hist, x)
+    for k in range(n_components):
+        sel = parts[k] if parts[k].size else np.array([min(bounds[k - 1], x.size - 1)])
+        weights[k] = max(hist[sel].sum(), 1) / n
+        means[k] = hist_moments(hist[sel], x[sel])[0] if hist[sel].sum() else x[sel[0]]
+        sigmas[k] = sigma_all / n_components
+    sigmas = np.maximum(sigmas, min_sigma)
+    weights /= weights.sum()
+
+    log_lik = -np.inf
+    for _ in range(n_iter):
+        # E-step - responsibilities of the components for the bins
+        dens = weights * _normal_pdf(x[:, np.newaxis], means, sigmas)
+        total = dens.sum(axis=1)
+        total[total == 0] = np.finfo(np.float64).tiny
+        resp = dens / total[:, np.newaxis]
+
+        # M-step - the responsibilities are weighted by the counts
+        w_resp = resp * hist[:, np.newaxis]
+        n_k = w_resp.sum(axis=0)
+        empty = n_k <= 0
+        n_k[empty] = 1
+        means_new = (w_resp * x[:, np.newaxis]).sum(axis=0) / n_k
+        var = (w_resp * (x[:, np.newaxis] - means_new) ** 2).sum(axis=0) / n_k
+        means = np.where(empty, means, means_new)
+        sigmas = np.where(empty, sigmas, np.maximum(np.sqrt(var), min_sigma))
+        weights = np.where(empty, 0, n_k / n)
+
+        log_lik_new = (hist * np.log(total)).sum() / n
+        if log_lik_new - log_lik < tol:
+            break
+        log_lik = log_lik_new
+
+    order = np.argsort(means)
+    return weights[order], means[order], sigmas[order]
+
+
+def mean_shift(hist, x, start, bandwidth, n_iter=20, tol=1e-3):
+    '''
+    Mode of a histogram found by gaussian-kernel mean shift from a starting value, every iteration costs O(n_bins).
+    :param hist: histogram counts
+    :param x: bin centers
+    :param start: starting value, e.g. the mean of a known model
+    :param bandwidth: standard deviation of the kernel
+    :param n_iter: maximal number of iterations
+    :param tol: the iteration stops when the estimate moves by less than tol
+    :return: mode
+    '''
+    hist = np.asarray(hist, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    mode = float(start)
+    for _ in range(n_iter):
+        w = hist * np.exp(-0.5 * ((x - mode) / bandwidth) ** 2)
+        if w.sum() == 0:
+            break
+        mode_new = (w * x).sum() / w.sum()
+        moved = abs(mode_new - mode)
+        mode = mode_new
+        if moved < tol:
+            break
+    return mode
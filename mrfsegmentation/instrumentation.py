@@ -0,0 +1,171 @@
+__author__ = 'tomas'
+
+import json
+import sys
+import time
+from collections import namedtuple
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# event passed to the hooks - phase is 'start' or 'end', the end and the measured values are None at the start
+StageEvent = namedtuple('StageEvent', ['stage', 'phase', 'start', 'end', 'wall', 'cpu', 'mem_delta', 'info'])
+
+# hooks notified about the stages of every segmentation
+_global_hooks = []
+
+if sys.version_info[0] < 3:
+    _cpu_time = time.clock
+else:
+    _cpu_time = time.process_time
+
+
+def _peak_memory():
+    # peak resident memory of the process in bytes (0 if unknown)
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def register_hook(hook):
+    '''
+    Register a hook notified about the stages of all segmentations.
+    :param hook: callable accepting a StageEvent
+    '''
+    if hook not in _global_hooks:
+        _global_hooks.append(hook)
+
+
+def unregister_hook(hook):
+    if hook in _global_hooks:
+        _global_hooks.remove(hook)
+
+
+def global_hooks():
+    return list(_global_hooks)
+
+
+class _NullStage():
+    # stage used when no hook is registered - nothing is measured
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set(self, **info):
+        pass
+
+
+NULL_STAGE = _NullStage()
+
+
+class Stage():
+    '''
+    Context manager measuring one stage and notifying the hooks.
+    Additional information (array sizes, node and edge counts, ...) can be attached with set().
+    '''
+
+    def __init__(self, name, hooks, **info):
+        self.name = name
+        self.hooks = hooks
+        self.info = info
+
+    def set(self, **info):
+        self.info.update(info)
+
+    def _notify(self, event):
+        for hook in self.hooks:
+            hook(event)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.cpu_start = _cpu_time()
+        self.mem_start = _peak_memory()
+        self._notify(StageEvent(self.name, 'start', self.start, None, None, None, None, dict(self.info)))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.time()
+        if exc_type is not None:
+            self.info['error'] = repr(exc_val)
+        self._notify(StageEvent(self.name, 'end', self.start, end, end - self.start, _cpu_time() - self.cpu_start,
+                                _peak_memory() - self.mem_start, dict(self.info)))
+        return False
+
+
+def stage(name, hooks, **info):
+    '''
+    Create a stage context manager, the returned stage costs nothing if there are no hooks.
+    :param name: name of the stage
+    :param hooks: hooks of the segmentation, the global hooks are added
+    :return: Stage or NULL_STAGE
+    '''
+    if _global_hooks:
+        hooks = list(hooks) + _global_hooks
+    if not hooks:
+        return NULL_STAGE
+    return Stage(name, hooks, **info)
+
+
+def print_hook(event):
+    # prints the stages as they start and finish (used by the verbose mode)
+    if event.phase == 'start':
+        print '%s ...' % event.stage,
+        sys.stdout.flush()
+    else:
+        print 'done (%.3f s)' % event.wall
+
+
+class StageCollector():
+    '''
+    Hook aggregating the wall and cpu time of the stages across many runs.
+    '''
+
+    def __init__(self):
+        self.stats = dict()
+        self.order = []
+
+    def __call__(self, event):
+        if event.phase != 'end':
+            return
+        if event.stage not in self.stats:
+            self.stats[event.stage] = {'count': 0, 'wall': 0., 'cpu': 0., 'wall_max': 0., 'mem_delta_max': 0}
+            self.order.append(event.stage)
+        stats = self.stats[event.stage]
+        stats['count'] += 1
+        stats['wall'] += event.wall
+        stats['cpu'] += event.cpu
+        stats['wall_max'] = max(stats['wall_max'], event.wall)
+        stats['mem_delta_max'] = max(stats['mem_delta_max'], event.mem_delta)
+
+    def reset(self):
+        self.stats = dict()
+        self.order = []
+
+    def summary(self):
+        '''
+        :return: dict stage -> {count, wall, cpu, wall_mean, cpu_mean, wall_max, mem_delta_max}
+        '''
+        summary = dict()
+        for name, stats in self.stats.items():
+            s = dict(stats)
+            s['wall_mean'] = stats['wall'] / stats['count']
+            s['cpu_mean'] = stats['cpu'] / stats['count']
+            summary[name] = s
+        return summary
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump({'order': self.order, 'stages': self.summary()}, f, indent=2, sort_keys=True)
+
+    def __str__(self):
+        lines = ['%-20s %6s %10s %10s %10s' % ('stage', 'count', 'wall [s]', 'cpu [s]', 'mean [s]')]
+        for name in self.order:
+            s = self.stats[name]
+            lines.append('%-20s %6i %10.3f %10.3f %10.3f' % (name, s['count'], s['wall'], s['cpu'],
+                                                             s['wall'] / s['count']))
+        return '\n'.join(lines)
@@ -1,27 +1,59 @@
 __author__ = 'tomas'
 
-import sys
-sys.path.append('../../imtools/')
-from imtools import tools
+import ConfigParser
+import warnings
 
 import numpy as np
-import matplotlib.pyplot as plt
 
-import cv2
-import skimage.data as skidat
-import skimage.segmentation as skiseg
-import skimage.exposure as skiexp
+# only numpy and the solver are needed by the segmentation itself, plotting and the other optional dependencies
+# (matplotlib, skimage) are imported on first use
+
+from color_model import ColorModel, IntensityLUT
+import grid_graph
+import resample
+import solvers
+import histogram
+import instrumentation
+import tiling
+import regions
+import planner
+import result_cache
+import model_bank
+
+
+def _solve_slice(i, edges, unaries, nodes, shape, pairwise, solver, n_iter, tol):
+    # solves one slice in a worker of run_slices
+    result = solvers.solve_grid(edges, unaries, pairwise, nodes, shape, method=solver, n_iter=n_iter, tol=tol)
+    return i, nodes, result.labels, result.energy
+
+
+# unary cost of the labels contradicting a seed in the incremental mode, see MarkovRandomField.update_seeds
+SEED_COST = 10 ** 6
 
-import pygco
-import scipy.stats as scista
-import ConfigParser
 
-from color_model import ColorModel
+def _compact_dtype(max_val):
+    # smallest integer dtype holding the values 0 .. max_val
+    for dtype in (np.uint8, np.uint16, np.int32):
+        if max_val <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
 
 
 class MarkovRandomField:
 
-    def __init__(self, img, seeds=None, n_objects=2, mask=None, alpha=1, beta=1, scale=0, models_estim=None, verbose=True):
+    def __init__(self, img, seeds=None, n_objects=2, mask=None, alpha=1, beta=1, scale=0, models_estim=None, verbose=True,
+                 params=None, lean=None):
+        # already parsed parameters (e.g. shipped to a worker process) are used instead of reading the config file
+        if params is None:
+            self.params = self.load_parameters()
+        else:
+            self.params = dict(params)
+        params = {'alpha': alpha, 'beta': beta, 'scale': scale}
+        self.params.update(params)
+
+        # lean mode - no copies of the inputs and compact unaries, see get_unaries_compact for the memory bound
+        self.lean = bool(self.params['lean'] if lean is None else lean)
+
         if img.ndim == 2:
             img = np.expand_dims(img, 0)
         if mask is not None and mask.ndim == 2:
@@ -29,23 +61,29 @@ class MarkovRandomField:
         if seeds is not None and seeds.ndim == 2:
             seeds = np.expand_dims(seeds, 0)
 
+        # memory-mapped inputs are not loaded, the working variables are views of them (as in the lean mode)
+        mapped = isinstance(img, np.memmap) or self.lean
+
         self.img_orig = img  # original variable
         # self.img = None  # working variable - i.e. resized data etc.
-        self.img = img.copy()  # working variable - i.e. resized data etc.
+        self.img = img if mapped else img.copy()  # working variable - i.e. resized data etc.
         self.seeds_orig = seeds  # original variable
         if seeds is not None:
-            self.seeds = seeds.copy()  # working variable - i.e. resized data etc.
+            self.seeds = seeds if mapped else seeds.copy()  # working variable - i.e. resized data etc.
         else:
             self.seeds = None
-        if mask is None:
+        if mask is None and mapped:
+            # read-only mask that does not allocate the volume
+            self.mask_orig = np.broadcast_to(np.ones(1, dtype=self.img.dtype), self.img.shape)
+        elif mask is None:
             self.mask_orig = np.ones_like(self.img)
         else:
             self.mask_orig = mask
-        self.mask = self.mask_orig.copy()
+        self.mask = self.mask_orig if mapped else self.mask_orig.copy()
 
         self.n_slices, self.n_rows, self.n_cols = self.img_orig.shape
         if seeds is not None:
-            self.n_seeds = (seeds > 0).sum()
+            self.n_seeds = np.count_nonzero(seeds)
         else:
             self.n_seeds = 0
 
@@ -59,11 +97,31 @@ class MarkovRandomField:
 
         self.unaries = None  # unary term = data term
         self.pairwise = None  # pairwise term = smoothness term
+        self.edges = None  # graph edges between the nodes inside the mask
+        self.nodes = None  # raveled indices of the voxels used as graph nodes
+        self.energy = None  # energy of the labelling reached by the solver
         self.labels = None  # labels of the final segmentation
 
         self.models = None  # list of intensity models used for segmentation
+        self.lut = None  # lookup table of the working image intensities
+        self.lut_img = None  # image the lookup table was built for
+        self.lut_step = None  # quantisation step the lookup table was built with
+        self.lut_basis = None  # intensities of the lookup table shared by the slabs of run_tiled
+        self.basis_table = None  # unary table of lut_basis evaluated once for all the slabs
+        self.hist = None  # histogram of the masked working image
+        self.hist_data = None  # image, mask and subsampling the histogram was computed from
+        self.grid_cache = None  # shared cache of grid topologies, see session.GridCache
+        self.buffer_pool = None  # shared pool of reused unary and label arrays, see session.BufferPool
+        self.seed_stats = None  # running (count, sum, sum of squares) of the seeded intensities per label
+        self.plan = None  # execution strategy chosen for the memory budget, see planner.MemoryPlan
+        self.disk_cache = None  # persistent cache of models, unaries and labels, see result_cache.ResultCache
+        self.cache_inputs = None  # fingerprints of the original image, seeds and mask keying the disk cache
+        self.has_mask = mask is not None  # if there are voxels outside the graph labelled by get_bgd_label()
+        self.cache_labels = True  # if run caches the final labels (sub-fields cache their models and unaries only)
 
         self.verbose = verbose
+        # hooks notified about the stages of the segmentation, see instrumentation.StageEvent
+        self.hooks = [instrumentation.print_hook] if verbose else []
 
         if models_estim is None:
             if seeds is not None:
@@ -73,12 +131,11 @@ class MarkovRandomField:
         elif models_estim == 'hydohy':
             self.n_objects = 3
             self.models_estim = models_estim
+        else:
+            self.models_estim = models_estim
 
-        self.params = self.load_parameters()
-        params = {'alpha': alpha, 'beta': beta, 'scale': scale}
-        self.params.update(params)
-
-    def load_parameters(self, config_path='config.ini'):
+    @staticmethod
+    def load_parameters(config_path='config.ini'):
         # load parameters
         params_default = {
             'win_l': 50,
@@ -93,11 +150,42 @@ class MarkovRandomField:
             'domin_simple_estim': 0,
             'prob_w': 0.001,
             'unaries_as_cdf': 0,
-            'bgd_label': 0,
+            'bgd_label': 'auto',
             'hypo_label': 1,
             'domin_label': 2,
             'hyper_label': 3,
             'hypo_mean_offset': -20,
+            'unaries_lut': 1,
+            'lut_quant_step': 0,
+            'hist_estim': 1,
+            'hist_subsample': 1,
+            'em_iter': 100,
+            'em_tol': 1e-6,
+            'model_bank': '',
+            'model_set': 'default',
+            'model_adapt': 0,
+            'model_adapt_subsample': 4,
+            'solver': 'pygco',
+            'solver_iter': 20,
+            'solver_tol': 0,
+            'per_slice': 0,
+            'n_workers': 0,
+            'slice_executor': 'thread',
+            'lean': 0,
+            'tile_size': 0,
+            'tile_halo': 4,
+            'refine_band': 0,
+            'crop': 0,
+            'crop_margin': 1,
+            'crop_seeds_margin': 32,
+            'memory_budget': 0,
+            'cache_dir': '',
+            'cache_size': '4G',
+            'incremental_solver': 'local',
+            'superpixels': 0,
+            'superpixel_method': 'slic',
+            'superpixel_size': 64,
+            'superpixel_compactness': 10,
             # 'voxel_size': (1, 1, 1)
         }
 
@@ -126,6 +214,33 @@ class MarkovRandomField:
 
         return params_default
 
+    def add_hook(self, hook):
+        '''
+        Register a hook notified about the stages of this segmentation.
+        :param hook: callable accepting an instrumentation.StageEvent
+        '''
+        if hook not in self.hooks:
+            self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        if hook in self.hooks:
+            self.hooks.remove(hook)
+
+    def _stage(self, name, **info):
+        return instrumentation.stage(name, self.hooks, **info)
+
+    def _buffer(self, name, shape, dtype):
+        # array of the given shape and dtype, taken from the shared buffer pool if there is one
+        if self.buffer_pool is None:
+            return np.empty(shape, dtype=dtype)
+        return self.buffer_pool.empty(name, shape, dtype)
+
+    def _grid_edges(self, mask, connectivity=None):
+        # edges and nodes of the in-mask voxels, full grids are taken from the shared cache if there is one
+        if self.grid_cache is None:
+            return grid_graph.masked_grid_edges(mask, connectivity)
+        return self.grid_cache.masked_edges(mask, connectivity)
+
     def _debug(self, msg, lineend):
         if self.verbose:
             if lineend:
@@ -133,38 +248,80 @@ class MarkovRandomField:
             else:
                 print msg,
 
+    def get_intensity_lut(self):
+        '''
+        Lookup table of the working image intensities, it is built once per working image and quantisation step.
+        :return: IntensityLUT or None if the lookup table evaluation is switched off or the image cannot be tabulated
+        '''
+        if not self.params['unaries_lut']:
+            return None
+        quant_step = self.params['lut_quant_step'] if self.params['lut_quant_step'] > 0 else None
+        if self.lut is None or self.lut_img is not self.img or self.lut_step != quant_step:
+            self.lut_img = self.img
+            self.lut_step = quant_step
+            try:
+                self.lut = IntensityLUT(self.img, quant_step=quant_step, basis=self.lut_basis)
+            except ValueError:
+                self.lut = None
+        return self.lut
+
+    def get_histogram(self):
+        '''
+        Histogram of the masked working image, it is computed once per working image, mask and subsampling in a single
+        streaming pass.
+        :return: hist, bin_centers
+        '''
+        subsample = self.params['hist_subsample']
+        if (self.hist is None or self.hist_data[0] is not self.img or self.hist_data[1] is not self.mask or
+                self.hist_data[2] != subsample):
+            self.hist_data = (self.img, self.mask, subsample)
+            self.hist = histogram.masked_histogram(self.img, self.mask, nbins=256 * histogram.FLOAT_BIN_REFINE,
+                                                   subsample=subsample)
+        return self.hist
+
     def estimate_dominant_pdf(self):
         perc = self.params['perc']
         k_std = self.params['k_std_dom']
         simple_estim = self.params['domin_simple_estim']
 
-        ints = self.img[np.nonzero(self.mask)]
-        hist, bins = skiexp.histogram(ints, nbins=256)
+        if self.params['hist_estim']:
+            # everything is derived from the masked histogram, the voxels are not touched again
+            hist_fine, bins_fine = self.get_histogram()
+            ints = None
+            if np.issubdtype(self.img.dtype, np.integer):
+                hist, bins = hist_fine, bins_fine
+            else:
+                # float images - the peak is searched in 256 bins, the moments are taken from the fine histogram
+                hist, bins = histogram.coarsen(hist_fine, bins_fine, histogram.FLOAT_BIN_REFINE)
+        else:
+            import skimage.exposure as skiexp
+            ints = self.img[np.nonzero(self.mask)]
+            hist, bins = skiexp.histogram(ints, nbins=256)
         if simple_estim:
-            mu, sigma = scista.norm.fit(ints)
+            if ints is None:
+                mu, sigma = histogram.hist_moments(hist_fine, bins_fine)
+            else:
+                mu, sigma = np.mean(ints), np.std(ints)
         else:
-            n_pts = self.mask.sum()
+            n_pts = hist.sum()
             perc_in = n_pts * perc / 100
 
             peak_idx = np.argmax(hist)
-            n_in = hist[peak_idx]
-            win_width = 0
-
-            while n_in < perc_in:
-                win_width += 1
-                n_in = hist[peak_idx - win_width:peak_idx + win_width].sum()
-                self._debug('win_w=%i, perc_in=%.0f, n_in=%.0f' % (win_width, perc_in, n_in), True)
+            win_width = histogram.peak_window(hist, peak_idx, perc_in)
 
             start_id = max(0, peak_idx - win_width)
             idx_start = bins[start_id]
             end_id = min(peak_idx + win_width, len(bins) - 1)
             idx_end = bins[end_id]
-            inners_m = np.logical_and(ints > idx_start, ints < idx_end)
-
-            inners = ints[np.nonzero(inners_m)]
 
             mu = bins[peak_idx]
-            sigma = k_std * np.std(inners)
+            if ints is None:
+                inners_m = (bins_fine > idx_start) & (bins_fine < idx_end)
+                sigma = k_std * histogram.hist_moments(hist_fine, bins_fine, inners_m)[1]
+            else:
+                inners_m = np.logical_and(ints > idx_start, ints < idx_end)
+                inners = ints[np.nonzero(inners_m)]
+                sigma = k_std * np.std(inners)
 
             # muse, sigmase = scista.norm.fit(ints)
             # print 'simple -> (%.1f, %.2f)' % (muse, sigmase)
@@ -175,27 +332,51 @@ class MarkovRandomField:
         cm = ColorModel(mu, sigma, type='pdf')
         return cm
 
+    def _fit_outliers(self, rv_domin, prob_t, outlier_type):
+        # mean and std of the masked intensities improbable under the dominant model lying below (hypo) or above (hyper)
+        # its mean, None if there are no such intensities
+        if self.params['hist_estim']:
+            hist, bins = self.get_histogram()
+            outliers = rv_domin.get_val(bins) < prob_t
+            if outlier_type == 'hypo':
+                outliers &= bins < rv_domin.mean
+            else:
+                outliers &= bins > rv_domin.mean
+            if hist[outliers].sum() == 0:
+                return None
+            return histogram.hist_moments(hist, bins, outliers)
+
+        lut = self.get_intensity_lut()
+        if lut is not None:
+            probs = lut.gather(rv_domin.get_val_lut(lut)).reshape(self.img.shape) * self.mask
+        else:
+            probs = rv_domin.get_val(self.img) * self.mask
+        ints_out_m = (probs < prob_t) * self.mask
+        ints_out = self.img[np.nonzero(ints_out_m)]
+        if outlier_type == 'hypo':
+            ints = ints_out[np.nonzero(ints_out < rv_domin.mean)]
+        else:
+            ints = ints_out[np.nonzero(ints_out > rv_domin.mean)]
+        if ints.size == 0:
+            return None
+        # maximum likelihood fit of a normal distribution
+        return np.mean(ints), np.std(ints)
+
     def estimate_outlier_pdf(self, rv_domin, outlier_type):
         self._debug('estimate_outlier_pdf: %s' % outlier_type, True)
         prob_w = self.params['prob_w']
 
-        probs = rv_domin.get_val(self.img) * self.mask
-
         max_prob = rv_domin.get_val(rv_domin.mean)
 
         prob_t = prob_w * max_prob
 
-        ints_out_m = (probs < prob_t) * self.mask
-
-        ints_out = self.img[np.nonzero(ints_out_m)]
-
         if outlier_type == 'hypo':
-            ints = ints_out[np.nonzero(ints_out < rv_domin.mean)]
-            if ints.size == 0:
+            fit = self._fit_outliers(rv_domin, prob_t, 'hypo')
+            if fit is None:
                 mu = 0
                 sigma = 1
             else:
-                mu, sigma = scista.norm.fit(ints)
+                mu, sigma = fit
             if self.params['unaries_as_cdf']:
                 cm = ColorModel(mu + self.params['hypo_mean_offset'], sigma * self.params['k_std_hypo'], type='sf', max_val=max_prob)
                 # cm = ColorModel(mu + self.params['hypo_mean_offset'], sigma * self.params['k_std_hypo'], type='sf')
@@ -204,12 +385,12 @@ class MarkovRandomField:
                 # cm = ColorModel(mu + self.params['hypo_mean_offset'], sigma, type='pdf')
             # y1 = scista.beta(1, 4).pdf(x)
         elif outlier_type == 'hyper':
-            ints = ints_out[np.nonzero(ints_out > rv_domin.mean)]
-            if ints.size == 0:
+            fit = self._fit_outliers(rv_domin, prob_t, 'hyper')
+            if fit is None:
                 mu = 255
                 sigma = 1
             else:
-                mu, sigma = scista.norm.fit(ints)
+                mu, sigma = fit
             if self.params['unaries_as_cdf']:
                 cm = ColorModel(mu, sigma, type='cdf', max_val=max_prob)
                 # cm = ColorModel(mu, sigma, type='cdf')
@@ -223,29 +404,92 @@ class MarkovRandomField:
         return cm
 
     def calc_models(self):
-        if self.models_estim == 'seeds':
+        if self.params['model_bank']:
+            models = self.calc_models_bank()
+        elif self.models_estim == 'seeds':
             models = self.calc_models_seeds()
         elif self.models_estim == 'hydohy':
             models = self.calc_models_hydohy()
+        elif self.models_estim == 'n_objects':
+            models = self.calc_models_n_objects()
         else:
             raise ValueError('Wrong type of model estimation mode.')
 
         return models
 
+    def get_seed_stats(self):
+        '''
+        Count, sum and sum of squares of the seeded intensities of every label, computed in one pass over the seeds and
+        then kept up to date by update_seeds.
+        :return: (count, sum, sum of squares) - float arrays indexed by the seed label
+        '''
+        if self.seed_stats is None:
+            inds = np.flatnonzero(self.seeds)
+            labels = self.seeds.ravel()[inds].astype(np.intp)
+            ints = np.asarray(self.img).ravel()[inds].astype(np.float64)
+            n = self.n_objects + 1
+            self.seed_stats = (np.bincount(labels, minlength=n).astype(np.float64),
+                               np.bincount(labels, weights=ints, minlength=n).astype(np.float64),
+                               np.bincount(labels, weights=ints ** 2, minlength=n).astype(np.float64))
+        return self.seed_stats
+
     def calc_models_seeds(self):
+        count, total, total_sq = self.get_seed_stats()
         models = list()
         for i in range(1, self.n_objects + 1):
-            pts = self.img[np.nonzero(self.seeds == i)]
-            mu = np.mean(pts)
-            sigma = np.std(pts)
+            mu = total[i] / count[i]
+            sigma = np.sqrt(max(total_sq[i] / count[i] - mu ** 2, 0))
 
             mu = int(mu)
-            sigma = int(sigma)
-            rv = scista.norm(mu, sigma)
-            models.append(rv)
+            # a zero sigma (constant seeds) would make the model degenerate
+            sigma = max(int(sigma), 1)
+            models.append(ColorModel(mu, sigma, type='pdf'))
 
         return models
 
+    def calc_models_n_objects(self):
+        '''
+        Unsupervised estimation of n_objects models - gaussian mixture fitted by EM to the masked histogram.
+        Every iteration works with the bins only, so its cost does not depend on the size of the volume.
+        :return: list of ColorModels sorted by their means
+        '''
+        hist, bins = self.get_histogram()
+        _, means, sigmas = histogram.gmm_em(hist, bins, self.n_objects, n_iter=self.params['em_iter'],
+                                            tol=self.params['em_tol'])
+        models = list()
+        for mu, sigma in zip(means, sigmas):
+            self._debug('\tobject pdf: mu = %.1f, sigma = %.1f' % (mu, sigma), True)
+            models.append(ColorModel(mu, sigma, type='pdf'))
+
+        return models
+
+    def calc_models_bank(self):
+        '''
+        Fixed models of a known protocol - the set params['model_set'] of the model bank params['model_bank']. With
+        params['model_adapt'] the models are shifted to the volume by the mean shift of their reference model on a
+        histogram subsampled by params['model_adapt_subsample'] (see model_bank.adapt_models).
+        :return: list of ColorModels
+        '''
+        models = model_bank.load_models(self.params['model_bank'], self.params['model_set'])
+        if len(models) != self.n_objects:
+            raise ValueError('Model set %s has %i models, %i objects are segmented.' % (self.params['model_set'],
+                                                                                   len(models), self.n_objects))
+        if self.params['model_adapt']:
+            hist, bins = histogram.masked_histogram(self.img, self.mask, nbins=256 * histogram.FLOAT_BIN_REFINE,
+                                                    subsample=self.params['model_adapt_subsample'])
+            models, shift = model_bank.adapt_models(models, hist, bins)
+            self._debug('\tmodels shifted by %.1f' % shift, True)
+        return models
+
+    def save_models(self, path, name=None):
+        '''
+        Store the models of this field (estimated if there are none yet) as a set of the model bank file path.
+        :param name: name of the set, defaults to params['model_set']
+        '''
+        if self.models is None:
+            self.models = self.calc_models()
+        model_bank.save_models(path, self.models, self.params['model_set'] if name is None else name)
+
     def calc_models_hydohy(self):
         # print 'calculating intensity models...'
         # dominant class ------------
@@ -265,6 +509,8 @@ class MarkovRandomField:
         return models
 
     def plot_models(self, nbins=256, show_now=True):
+        import matplotlib.pyplot as plt
+        import skimage.exposure as skiexp
         plt.figure()
         x = np.arange(self.img.min(), self.img.max())  # artificial x-axis
 
@@ -282,14 +528,63 @@ class MarkovRandomField:
             if show_now:
                 plt.show()
 
+    def get_unary_table(self, lut):
+        '''
+        Unaries of all the models tabulated over the intensities of the lookup table.
+        :param lut: IntensityLUT of the working image
+        :return: int32 table (n_values, n_objects)
+        '''
+        if lut.basis is not None and lut.basis is self.lut_basis and self.basis_table is not None:
+            return self.basis_table
+        if self.models is None:
+            self.models = self.calc_models()
+        return np.column_stack([x.get_inverse_lut(lut, rescale=True) for x in self.models]).astype(np.int32)
+
+    def get_unaries_compact(self):
+        '''
+        Unaries weighted by beta built in place into one preallocated (n_pts, n_objects) array of the smallest integer
+        dtype holding 255 * beta (uint8 for beta = 1), non-integer products are rounded.
+        Peak memory of the lean mode with N voxels of the working image, K objects and n nodes in the mask:
+            unaries N * K * b (b = 1, 2 or 4 bytes) + lookup table index N * (1 or 2) + mask test N
+            + graph n * (4 * K + 8 + 8 * n_dims)
+        i.e. for uint8 unaries and a small mask about N * (K + 3) bytes, the internal graph of the solver excluded.
+        :return: unaries (n_pts, n_objects)
+        '''
+        if self.models is None:
+            self.models = self.calc_models()
+        n_objects = len(self.models)
+        dtype = _compact_dtype(255 * self.beta)
+        unaries = self._buffer('unaries', (self.img.size, n_objects), dtype)
+
+        lut = self.get_intensity_lut()
+        if lut is not None:
+            table = self.get_unary_table(lut) * self.beta
+            np.take(np.round(table).astype(dtype), lut.idx, axis=0, out=unaries)
+        else:
+            import skimage.exposure as skiexp
+            for i, x in enumerate(self.models):
+                u = skiexp.rescale_intensity(x.get_inverse(self.img), out_range=np.uint8).astype(np.int32) * self.beta
+                unaries[:, i] = np.round(u).ravel()
+                del u
+        return unaries
+
     def get_unaries(self, ret_prob=False, show=False, show_now=True):
         if self.models is None:
             self.models = self.calc_models()
 
-        # unaries_l = [x.get_log_val(self.img) for x in self.models]
-        unaries_l = [skiexp.rescale_intensity(x.get_inverse(self.img), out_range=np.uint8) for x in self.models]
+        lut = self.get_intensity_lut()
+        if lut is not None:
+            # the models are evaluated once per intensity and the unary stack is gathered in a single pass
+            unaries = lut.gather(self.get_unary_table(lut)).reshape(-1, 1, len(self.models))
+            unaries_l = [unaries[:, 0, i] for i in range(len(self.models))]
+        else:
+            import skimage.exposure as skiexp
+            # unaries_l = [x.get_log_val(self.img) for x in self.models]
+            unaries_l = [skiexp.rescale_intensity(x.get_inverse(self.img), out_range=np.uint8) for x in self.models]
+            unaries = np.dstack([x.reshape(-1, 1) for x in unaries_l])
 
         if show:
+            import matplotlib.pyplot as plt
             plt.figure()
             for i, u in enumerate(unaries_l):
                 plt.subplot(1, 3, i + 1)
@@ -300,10 +595,13 @@ class MarkovRandomField:
             if show_now:
                 plt.show()
 
-        un_probs_l = [x.get_val(self.img) for x in self.models]
-
-        unaries = np.dstack((x.reshape(-1, 1) for x in unaries_l))
-        un_probs = np.dstack((x.reshape(-1, 1) for x in un_probs_l))
+        if ret_prob:
+            if lut is not None:
+                table = np.column_stack([x.get_val_lut(lut) for x in self.models])
+                un_probs = lut.gather(table).reshape(-1, 1, len(self.models))
+            else:
+                un_probs_l = [x.get_val(self.img) for x in self.models]
+                un_probs = np.dstack([x.reshape(-1, 1) for x in un_probs_l])
 
         # x = np.arange(0, 255, 1)
         # y_hypo_p = self.models[0].get_val(x)
@@ -338,6 +636,69 @@ class MarkovRandomField:
             return unaries.astype(np.int32)
             # return unaries
 
+    def cache_key(self, stage, resize=True, solver=None):
+        '''
+        Key of a stage in the disk cache - digest of the original inputs, the parameters the stage depends on (see
+        result_cache.STAGE_PARAMS) and the models the stage is computed from, if they are known.
+        :param stage: 'models', 'unaries' or 'labels'
+        :param resize: resize argument of run (labels only)
+        :param solver: solver argument of run (labels only)
+        '''
+        if self.cache_inputs is None:
+            self.cache_inputs = tuple(result_cache.fingerprint(x) for x in (self.img_orig, self.seeds_orig,
+                                                                               self.mask_orig))
+        params = dict(self.params, alpha=self.alpha, beta=self.beta, scale=self.scale, lean=int(self.lean))
+        parts = (self.cache_inputs, self.models_estim, self.n_objects)
+        if stage == 'labels':
+            params['solver'] = solver or params['solver']
+            parts += (result_cache.stage_key('solve', params), bool(resize),
+                      tuple((p, params.get(p)) for p in result_cache.RUN_PARAMS))
+        else:
+            # the working image of the stage, e.g. the full-size one of the models of the tiled mode
+            parts += (result_cache.stage_key(stage, params), self.img.shape)
+        if stage != 'models' and self.models is not None:
+            parts += result_cache.models_key(self.models)
+        if stage != 'models' and self.lut_basis is not None:
+            # the unaries of a slab are normalised over the intensities of the whole volume
+            basis = self.lut_basis
+            parts += ('basis', float(basis.lo), basis.quant_step, result_cache.fingerprint(basis.present))
+        if self.params['model_bank']:
+            # the models of a bank enter by their values, so a set replaced in the same file invalidates the entries
+            bank_models = model_bank.load_models(self.params['model_bank'], self.params['model_set'])
+            parts += ('bank',) + result_cache.models_key(bank_models)
+        return result_cache.digest(stage, *parts)
+
+    def calc_models_cached(self):
+        # calc_models through the disk cache
+        if self.disk_cache is None:
+            return self.calc_models()
+        key = self.cache_key('models')
+        models = self.disk_cache.load_models(key)
+        if models is None:
+            models = self.calc_models()
+            self.disk_cache.save_models(key, models)
+        return models
+
+    def get_unaries_cached(self):
+        '''
+        Unaries of the working image (compact in the lean mode), memory-mapped from the disk cache if they were computed
+        for the same inputs, models and unary parameters before.
+        '''
+        if self.disk_cache is not None:
+            if self.models is None:
+                self.models = self.calc_models_cached()
+            key = self.cache_key('unaries')
+            unaries = self.disk_cache.load_array(key)
+            if unaries is not None:
+                return unaries
+        if self.lean:
+            unaries = self.get_unaries_compact()
+        else:
+            unaries = self.beta * self.get_unaries()
+        if self.disk_cache is not None:
+            self.disk_cache.save_array(key, unaries)
+        return unaries
+
     def set_unaries(self, unaries, resize=False):
         '''
         Set unary term.
@@ -362,6 +723,8 @@ class MarkovRandomField:
         self.pairwise = - self.alpha * np.eye(self.n_objects, dtype=np.int32)
 
     def show_slice(self, slice_id, show_now=True):
+        import matplotlib.pyplot as plt
+        import skimage.segmentation as skiseg
         plt.figure()
         plt.subplot(221), plt.imshow(self.img_orig[slice_id, :, :], 'gray', interpolation='nearest'), plt.title('input image')
         plt.subplot(222), plt.imshow(self.seeds_orig[slice_id, :, :], interpolation='nearest'), plt.title('seeds')
@@ -371,12 +734,169 @@ class MarkovRandomField:
         if show_now:
             plt.show()
 
-    def run(self, resize=True):
-        #----  rescaling  ----
+    def _sub_field(self, img, seeds, mask):
+        # field of a sub-volume sharing the parameters and the intensity models of this one
+        mrf = MarkovRandomField(img, seeds, n_objects=self.n_objects, mask=mask, alpha=self.alpha, beta=self.beta,
+                                scale=self.scale, models_estim=self.models_estim, verbose=False, params=self.params,
+                                lean=self.lean)
+        mrf.n_objects = self.n_objects
+        mrf.models = self.models
+        mrf.hooks = [h for h in self.hooks if h is not instrumentation.print_hook]
+        mrf.grid_cache = self.grid_cache
+        mrf.plan = self.plan
+        mrf.disk_cache = self.disk_cache
+        mrf.cache_labels = False
+        # the slabs and the crop box always get a mask, the background of the sub-volume is that of this field
+        mrf.has_mask = self.has_mask
+        return mrf
+
+    def get_roi(self):
+        '''
+        Region of interest of the segmentation - the bounding box of the mask (together with the seeds, they are needed
+        by the models) padded by params['crop_margin']. Without a mask the box of the seeds padded by
+        params['crop_seeds_margin'] is used.
+        :return: tuple of slices of the original volume, None if the whole volume is needed
+        '''
+        mask = self.mask_orig
+        full_mask = all(st == 0 for st in mask.strides) and np.asarray(mask).flat[0] != 0
+        box = None if full_mask else tiling.bounding_box(mask, self.params['crop_margin'])
+        if box is not None and box != tuple(slice(0, s) for s in mask.shape):
+            if self.seeds_orig is not None:
+                box = tiling.union_box(box, tiling.bounding_box(self.seeds_orig))
+        elif self.seeds_orig is not None and self.n_seeds:
+            box = tiling.bounding_box(self.seeds_orig, self.params['crop_seeds_margin'])
+        else:
+            box = None
+        if box is None or box == tuple(slice(0, s) for s in mask.shape):
+            return None
+        return box
+
+    def run_cropped(self, roi=None, resize=True, solver=None, out=None):
+        '''
+        Segmentation of a region of interest - all the stages run on the sub-volume only and its labels are pasted into
+        a full-size volume filled with get_bgd_label().
+        :param roi: tuple of slices, defaults to get_roi()
+        :param out: optional preallocated output array (e.g. np.memmap) of the shape of the original image
+        :return: labels of the original shape
+        '''
+        if roi is None:
+            roi = self.get_roi()
+        if roi is None:
+            params_crop = self.params['crop']
+            self.params['crop'] = 0
+            try:
+                return self.run(resize=resize, solver=solver, out=out)
+            finally:
+                self.params['crop'] = params_crop
+
+        seeds = self.seeds_orig[roi] if self.seeds_orig is not None else None
+        with self._stage('crop', shape=self.img_orig.shape, roi=[(s.start, s.stop) for s in roi]):
+            mrf = self._sub_field(self.img_orig[roi], seeds, self.mask_orig[roi])
+            mrf.params['crop'] = 0
+            mrf.hooks = self.hooks
+            mrf.verbose = self.verbose
+        labels = mrf.run(resize=resize, solver=solver)
+
+        with self._stage('paste', shape=self.img_orig.shape):
+            if out is None:
+                out = np.empty(self.img_orig.shape, dtype=np.int32)
+            out.fill(self.get_bgd_label())
+            out[roi] = labels
+        self.models = mrf.models
+        self.energy = mrf.energy
+        self.labels_orig = out
+        self.labels = out
+        return self.labels_orig
+
+    def run_tiled(self, tile_size=None, halo=None, resize=True, out=None, solver=None):
+        '''
+        Out-of-core segmentation - the volume is split into overlapping slabs along the slice axis, every slab is solved
+        with the global intensity models and unary table and only the core region of the slab is kept.
+        :param tile_size: number of core slices per slab, defaults to params['tile_size']
+        :param halo: number of overlapping slices on each side of the core, defaults to params['tile_halo']
+        :param resize: if to solve the slabs at the scale self.scale
+        :param out: optional preallocated output array (e.g. np.memmap) of the shape of the original image, defaults to
+                    the smallest dtype holding the labels (see label_dtype)
+        :param solver: solver of the slabs, defaults to params['solver']
+        :return: labels of the original shape, self.energy is the sum of the energies of the slabs
+        '''
+        if tile_size is None:
+            tile_size = self.params['tile_size']
+        if halo is None:
+            halo = self.params['tile_halo']
+        ranges = tiling.slab_ranges(self.img_orig.shape[0], tile_size, halo)
+
+        #----  calculating intensity models  ----
+        # the models are estimated once from the whole volume and shared by all the slabs
+        if self.models is None:
+            with self._stage('models'):
+                self.models = self.calc_models_cached()
+
+        #----  tabulating unaries  ----
+        # the unary table is normalised over the intensities of the whole working image, so the slabs gather the same
+        # unaries as the segmentation of the whole volume - the working image is resampled in-plane only, so its slices
+        # are passed slab by slab and never held at once
+        basis = table = None
+        if self.params['unaries_lut']:
+            with self._stage('unaries', shape=self.img_orig.shape, n_objects=self.n_objects) as stage:
+                def cores():
+                    for _, _, core_start, core_stop in ranges:
+                        part = self.img_orig[core_start:core_stop]
+                        yield resample.downsample_mean(part, self.scale) if resize and self.scale != 0 else part
+                quant_step = self.params['lut_quant_step'] if self.params['lut_quant_step'] > 0 else None
+                try:
+                    basis = IntensityLUT.of_parts(cores, quant_step=quant_step)
+                except ValueError:
+                    # the slabs evaluate the models on their own intensities
+                    basis = None
+                else:
+                    table = self.get_unary_table(basis)
+                stage.set(tabulated=basis is not None)
+
+        if out is None:
+            out = np.empty(self.img_orig.shape, dtype=self.label_dtype())
+
+        self.energy = 0
+        for i, (start, stop, core_start, core_stop) in enumerate(ranges):
+            with self._stage('slab', index=i, n_slabs=len(ranges), start=start, stop=stop) as stage:
+                seeds = self.seeds_orig[start:stop] if self.seeds_orig is not None else None
+                mrf = self._sub_field(self.img_orig[start:stop], seeds, self.mask_orig[start:stop])
+                mrf.params['tile_size'] = 0
+                mrf.lut_basis = basis
+                mrf.basis_table = table
+                labels = mrf.run(resize=resize, solver=solver)
+                out[core_start:core_stop] = labels[core_start - start:core_stop - start]
+                stage.set(energy=mrf.energy)
+                self.energy = None if self.energy is None or mrf.energy is None else self.energy + mrf.energy
+                del mrf, labels
+
+        self.labels_orig = out
+        self.labels = out
+
+        self._debug('----------', True)
+        self._debug('segmentation done', True)
+
+        return self.labels_orig
+
+    def label_dtype(self):
+        '''
+        Smallest dtype of the assembled label volumes holding the labels 0 .. n_objects - 1 and the background label.
+        '''
+        bgd = self.get_bgd_label()
+        if bgd < 0:
+            return np.int32
+        return _compact_dtype(max(self.n_objects - 1, bgd))
+
+    def _rescale_input(self, resize):
+        # working image, seeds and mask at the scale self.scale
         if resize and self.scale != 0:
-            self.img = tools.resize3D(self.img_orig, self.scale, sliceId=0)
-            self.seeds = tools.resize3D(self.seeds_orig, self.scale, sliceId=0)
-            self.mask = tools.resize3D(self.mask_orig, self.scale, sliceId=0)
+            with self._stage('rescale', shape=self.img_orig.shape, scale=self.scale):
+                # intensities are averaged, seeds and mask are max-pooled so that sparse seeds are not lost
+                self.img = resample.downsample_mean(self.img_orig, self.scale)
+                if self.seeds_orig is not None:
+                    self.seeds = resample.downsample_max(self.seeds_orig, self.scale)
+                    self.seed_stats = None
+                self.mask = resample.downsample_max(self.mask_orig, self.scale)
             # for i, (im, seeds, mask) in enumerate(zip(self.img_orig, self.seeds_orig, self.mask_orig)):
             #     self.img[i, :, :] = cv2.resize(im, (0,0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_NEAREST)
             #     self.seeds[i, :, :] = cv2.resize(seeds, (0,0),  fx=self.scale, fy=self.scale, interpolation=cv2.INTER_NEAREST)
@@ -386,64 +906,529 @@ class MarkovRandomField:
         #     self.seeds = self.seeds_orig
         self.n_slices, self.n_rows, self.n_cols = self.img.shape
 
+    def _rescale_labels(self, resize):
+        # labels of the original size
+        if resize and self.scale != 0:
+            with self._stage('rescale_labels', shape=self.labels.shape, scale=1. / self.scale):
+                # self.labels_orig = cv2.resize(self.labels, (0,0),  fx=1. / self.scale, fy= 1. / self.scale, interpolation=cv2.INTER_NEAREST)
+                self.labels_orig = resample.upsample_nearest(self.labels, self.img_orig.shape)
+        else:
+            self.labels_orig = self.labels
+
+    def solve(self, edges, unaries, nodes, shape, solver=None, init=None):
+        '''
+        Solve the labelling of a grid graph by the selected solver, the reached energy is stored in self.energy.
+        :param edges: edges between the nodes
+        :param unaries: unaries of the nodes (n_nodes, n_objects)
+        :param nodes: raveled indices of the nodes in the grid of the given shape
+        :param solver: 'pygco', 'icm' or 'mean_field', defaults to params['solver']
+        :param init: initial labels of the nodes (warm start of icm)
+        :return: labels of the nodes
+        '''
+        if solver is None:
+            solver = self.params['solver']
+        colors = None
+        if solver != 'pygco' and self.grid_cache is not None:
+            colors = self.grid_cache.colors(nodes, shape)
+        result = solvers.solve_grid(edges, unaries, self.pairwise, nodes, shape, method=solver,
+                                    n_iter=self.params['solver_iter'], tol=self.params['solver_tol'], colors=colors,
+                                    init=init)
+        self.energy = result.energy
+        return result.labels
+
+    def run_slices(self, resize=True, solver=None, n_workers=None, executor=None):
+        '''
+        Per-slice segmentation - every slice is solved as an independent 2D graph with the global intensity models.
+        The slices are distributed over a pool of workers and written into one preallocated label volume.
+        :param resize: if to solve the slices at the scale self.scale
+        :param solver: solver of the slices, defaults to params['solver']
+        :param n_workers: number of workers, defaults to params['n_workers'] (0 = number of cpus)
+        :param executor: 'thread' or 'process', defaults to params['slice_executor']
+        :return: labels of the original shape
+        '''
+        import concurrent.futures as confut
+        import multiprocessing
+
+        if solver is None:
+            solver = self.params['solver']
+        if n_workers is None:
+            n_workers = self.params['n_workers']
+        if not n_workers:
+            n_workers = multiprocessing.cpu_count()
+        if executor is None:
+            executor = self.params['slice_executor']
+
+        self._rescale_input(resize)
+
+        if self.models is None:
+            with self._stage('models', shape=self.img.shape):
+                self.models = self.calc_models_cached()
+
+        if self.pairwise is None:
+            with self._stage('pairwise'):
+                self.set_pairwise()
+
+        with self._stage('unaries', shape=self.img.shape, n_objects=self.n_objects):
+            # with a lookup table only the table is prepared here, the unaries are gathered slice by slice
+            lut = self.get_intensity_lut() if self.unaries is None else None
+            if lut is not None:
+                table = self.beta * self.get_unary_table(lut)
+                idx = lut.idx.reshape(self.img.shape[0], -1)
+            elif self.unaries is None:
+                self.unaries = self.get_unaries_cached()
+            if lut is None:
+                unaries = self.unaries.reshape(self.img.shape[0], -1, self.n_objects)
+
+        slice_shape = self.img.shape[1:]
+        with self._stage('edges', shape=slice_shape):
+            # the edges of a full slice are shared by all the slices without masked voxels
+            if self.grid_cache is not None:
+                edges_full, nodes_full, _ = self.grid_cache.template(slice_shape)
+            else:
+                edges_full, nodes_full = grid_graph.masked_grid_edges(np.ones(slice_shape, dtype=np.bool_))
+
+        def slice_jobs():
+            for i in range(self.img.shape[0]):
+                mask = np.asarray(self.mask[i]) != 0
+                if mask.all():
+                    edges, nodes = edges_full, nodes_full
+                else:
+                    edges, nodes = grid_graph.masked_grid_edges(mask)
+                if lut is not None:
+                    un = table[idx[i][nodes]]
+                else:
+                    un = unaries[i][nodes]
+                yield (i, edges, un, nodes, slice_shape, self.pairwise, solver, self.params['solver_iter'],
+                       self.params['solver_tol'])
+
+        self.labels = self._buffer('labels', self.img.shape, np.int32)
+        self.energy = 0
+        pool_class = confut.ProcessPoolExecutor if executor == 'process' else confut.ThreadPoolExecutor
+        with self._stage('graph_cut', n_slices=self.img.shape[0], n_workers=n_workers) as stage:
+            with pool_class(max_workers=n_workers) as pool:
+                jobs = slice_jobs()
+                pending = set()
+                exhausted = False
+                while True:
+                    # at most two slices per worker are prepared at once
+                    while not exhausted and len(pending) < 2 * n_workers:
+                        try:
+                            pending.add(pool.submit(_solve_slice, *next(jobs)))
+                        except StopIteration:
+                            exhausted = True
+                    if not pending:
+                        break
+                    done, pending = confut.wait(pending, return_when=confut.FIRST_COMPLETED)
+                    for future in done:
+                        i, nodes, labels, energy = future.result()
+                        self.labels[i] = grid_graph.scatter_labels(labels, nodes, slice_shape,
+                                                                   bgd_label=self.get_bgd_label(), dtype=np.int32)
+                        self.energy += energy
+            stage.set(solver=solver, energy=self.energy)
+
+        self._rescale_labels(resize)
+
+        self._debug('----------', True)
+        self._debug('segmentation done', True)
+
+        return self.labels_orig
+
+    def update_seeds(self, added=None, removed=None, solver=None):
+        '''
+        Incremental re-segmentation after an edit of the seeds.
+        The seed statistics are updated from the deltas only, the unaries are recomputed only if a seed model changed
+        and the graph of the previous run is reused. All the seeds are hard constraints of the labelling. If the
+        unaries did not change and params['incremental_solver'] is 'local', the previous labels are updated by icm in
+        the neighbourhood of the edited seeds only (solvers.solve_icm_local), so the cost depends on the size of the
+        affected region rather than on the size of the volume. Otherwise the whole graph is solved, icm starts from the
+        previous labels and pygco from scratch.
+        :param added: (n, 4) rows (slice, row, col, label) of the new seeds in the original coordinates, the label of an
+                      already seeded voxel is replaced
+        :param removed: (n, 3) coordinates (slice, row, col) of the removed seeds in the original coordinates
+        :param solver: solver of the labelling, defaults to params['solver']
+        :return: labels of the original shape
+        '''
+        if self.nodes is None:
+            # no previous run, the working volume is prepared first
+            self._rescale_input(True)
+        if self.seeds is None:
+            self.seeds = np.zeros(self.img.shape, dtype=np.uint8)
+        elif self.seeds is self.seeds_orig:
+            # the input seeds are never modified
+            self.seeds = self.seeds.copy()
+        count, total, total_sq = self.get_seed_stats()
+        ints = np.asarray(self.img).ravel()
+        seeds_flat = self.seeds.reshape(-1)
+
+        def flat_inds(coords):
+            coords = resample.scaled_coords(coords, self.img_orig.shape, self.img.shape)
+            return np.ravel_multi_index(tuple(coords.T), self.img.shape)
+
+        def move(inds, labels):
+            # move the voxels from their current labels to the given ones in the statistics and the seeds
+            old = seeds_flat[inds].astype(np.intp)
+            x = ints[inds].astype(np.float64)
+            for sign, lab in ((-1, old), (1, labels)):
+                count[:] += sign * np.bincount(lab, minlength=count.size)[:count.size]
+                total[:] += sign * np.bincount(lab, weights=x, minlength=count.size)[:count.size]
+                total_sq[:] += sign * np.bincount(lab, weights=x ** 2, minlength=count.size)[:count.size]
+            count[0] = total[0] = total_sq[0] = 0
+            seeds_flat[inds] = labels
+
+        edited = [np.zeros(0, dtype=np.intp)]
+        with self._stage('seeds'):
+            if removed is not None and len(removed):
+                inds = np.unique(flat_inds(np.asarray(removed)[:, :3]))
+                move(inds, np.zeros(inds.size, dtype=np.intp))
+                edited.append(inds)
+            if added is not None and len(added):
+                added = np.asarray(added, dtype=np.intp).reshape(-1, 4)
+                if added[:, 3].min() < 1 or added[:, 3].max() > self.n_objects:
+                    raise ValueError('Seed labels have to be in 1 .. n_objects.')
+                inds, last = np.unique(flat_inds(added[:, :3])[::-1], return_index=True)
+                move(inds, added[::-1][last, 3])
+                edited.append(inds)
+            self.n_seeds = int(count.sum())
+        edited = np.concatenate(edited)
+
+        if self.models_estim == 'seeds':
+            with self._stage('models', shape=self.img.shape):
+                models = self.calc_models_seeds()
+                changed = self.models is None or any((m.mean, m.sigma) != (o.mean, o.sigma)
+                                                     for m, o in zip(models, self.models))
+                if changed:
+                    self.models = models
+                    self.unaries = None
+        elif self.models is None:
+            self.models = self.calc_models()
+
+        # with unchanged unaries the edit is propagated locally from the previous labels
+        local = (self.unaries is not None and self.labels is not None and self.labels.shape == self.img.shape and
+                 self.params['incremental_solver'] == 'local')
+
+        if self.unaries is None:
+            with self._stage('unaries', shape=self.img.shape, n_objects=self.n_objects):
+                self.unaries = self.get_unaries_cached()
+
+        if self.pairwise is None:
+            self.set_pairwise()
+
+        if local:
+            unaries_flat = self.unaries.reshape(-1, self.n_objects)
+
+            def unary_rows(inds):
+                # unaries of the voxels with the hard constraints at the seeds
+                u = unaries_flat[inds].astype(np.float64)
+                lab = seeds_flat[inds].astype(np.intp)
+                seeded = np.flatnonzero(lab)
+                u[seeded] = SEED_COST
+                u[seeded, lab[seeded] - 1] = 0
+                return u
+
+            with self._stage('graph_cut', n_edited=edited.size) as stage:
+                # all the seeds are activated as the labels of the previous run may not respect them
+                active = np.r_[edited, np.flatnonzero(self.seeds)]
+                n_sweeps, n_changed = solvers.solve_icm_local(unary_rows, self.pairwise, self.labels, self.mask,
+                                                              active, n_iter=self.params['solver_iter'])
+                # the energy of the whole graph is not evaluated in the local mode
+                self.energy = None
+                stage.set(solver='icm_local', n_iter=n_sweeps, n_changed=n_changed)
+            self._rescale_labels(True)
+            return self.labels_orig
+
+        if self.edges is None:
+            with self._stage('edges', shape=self.img.shape):
+                self.edges, self.nodes = self._grid_edges(self.mask)
+
+        with self._stage('graph_cut', n_nodes=self.nodes.size, n_edges=self.edges.shape[0]) as stage:
+            unaries_in = self.unaries.reshape(-1, self.n_objects)[self.nodes, :].astype(np.int32)
+            # hard constraints - every label but the seeded one is penalized at the seeds inside the mask
+            seed_inds = np.flatnonzero(self.seeds)
+            pos = np.searchsorted(self.nodes, seed_inds)
+            inside = pos < self.nodes.size
+            inside[inside] = self.nodes[pos[inside]] == seed_inds[inside]
+            pos = pos[inside]
+            unaries_in[pos, :] = SEED_COST
+            unaries_in[pos, seeds_flat[seed_inds[inside]].astype(np.intp) - 1] = 0
+            init = None
+            if self.labels is not None and self.labels.shape == self.img.shape:
+                init = np.clip(self.labels.ravel()[self.nodes], 0, self.n_objects - 1)
+            result_graph = self.solve(self.edges, unaries_in, self.nodes, self.img.shape, solver, init=init)
+            stage.set(solver=solver or self.params['solver'], energy=self.energy)
+            self.labels = grid_graph.scatter_labels(result_graph, self.nodes, self.img.shape,
+                                                    bgd_label=self.get_bgd_label(), dtype=np.int32,
+                                                    out=self._buffer('labels', self.img.shape, np.int32))
+
+        self._rescale_labels(True)
+        return self.labels_orig
+
+    def refine_boundaries(self, width=None, solver=None):
+        '''
+        Coarse-to-fine refinement of the upsampled labels.
+        Only the voxels in a narrow band around the boundaries of self.labels_orig are re-solved at the full resolution,
+        the voxels outside the band keep their coarse labels and enter the graph as fixed neighbours of the band. The
+        full-resolution unaries are evaluated for the band voxels only, by interpolating the unary table of the working
+        intensities so that they are on the same scale as the coarse unaries.
+        :param width: half-width of the band in full-resolution voxels, defaults to params['refine_band']
+        :param solver: solver of the band, defaults to params['solver']
+        :return: refined labels of the original shape
+        '''
+        if width is None:
+            width = self.params['refine_band']
+        if solver is None:
+            solver = self.params['solver']
+        labels = self.labels_orig
+        mask = np.asarray(self.mask_orig) != 0
+
+        with self._stage('band', shape=labels.shape, width=width) as stage:
+            # the slices are not resampled, the band grows in-plane only
+            band = grid_graph.boundary_band(labels, mask, width, axes=resample.PLANE_AXES)
+            node_ids, nodes = grid_graph.mask_node_ids(band)
+            stage.set(n_nodes=nodes.size)
+
+        with self._stage('band_unaries', n_nodes=nodes.size, n_objects=self.n_objects):
+            lut = self.get_intensity_lut()
+            if lut is None:
+                # float images without a quantisation step - the table is built over 4096 levels of the working image
+                img_range = float(self.img.max() - self.img.min())
+                lut = IntensityLUT(self.img, quant_step=img_range / 4095 if img_range > 0 else 1.)
+            table = self.beta * self.get_unary_table(lut)
+            ints = np.asarray(self.img_orig).ravel()[nodes].astype(np.float64)
+            unaries = np.empty((nodes.size, self.n_objects), dtype=np.int64)
+            for k in range(self.n_objects):
+                unaries[:, k] = np.round(np.interp(ints, lut.x, table[:, k]))
+            del ints
+            if self.pairwise is None:
+                self.set_pairwise()
+            unaries += grid_graph.fixed_neighbour_costs(band, mask & ~band, labels, node_ids, self.pairwise,
+                                                        nodes.size)
+
+        with self._stage('band_edges', n_nodes=nodes.size) as stage:
+            edges, _ = grid_graph.masked_grid_edges(band)
+            del node_ids
+            stage.set(n_edges=edges.shape[0])
+
+        with self._stage('band_cut', n_nodes=nodes.size, n_edges=edges.shape[0]) as stage:
+            result = solvers.solve_grid(edges, unaries.astype(np.int32), self.pairwise, nodes, labels.shape,
+                                        method=solver, n_iter=self.params['solver_iter'],
+                                        tol=self.params['solver_tol'])
+            labels.flat[nodes] = result.labels
+            stage.set(solver=solver, energy=result.energy)
+
+        self.labels_orig = labels
+        return self.labels_orig
+
+    def run_regions(self, resize=True, solver=None):
+        '''
+        Segmentation of supervoxels - the volume is over-segmented and the labelling is solved on the region adjacency
+        graph. The unaries of a region are the sums of the unaries of its voxels and the edges are weighted by the
+        boundary lengths, so the graph is much smaller than the voxel grid while the region boundaries are kept at the
+        working resolution.
+        :param resize: if to segment at the scale self.scale
+        :param solver: solver of the graph, defaults to params['solver'] (the approximate solvers update all the
+                       regions at once as the graph is not bipartite)
+        :return: labels of the original shape
+        '''
+        if solver is None:
+            solver = self.params['solver']
+
+        self._rescale_input(resize)
+
+        with self._stage('superpixels', shape=self.img.shape, method=self.params['superpixel_method']) as stage:
+            n_segments = max(1, np.count_nonzero(self.mask) // self.params['superpixel_size'])
+            sp = regions.supervoxels(self.img, n_segments, method=self.params['superpixel_method'],
+                                     compactness=self.params['superpixel_compactness'])
+            region_ids, self.nodes, n_regions = regions.mask_regions(sp, self.mask)
+            del sp
+            stage.set(n_regions=n_regions)
+
+        if self.models is None:
+            with self._stage('models', shape=self.img.shape):
+                self.models = self.calc_models_cached()
+
+        with self._stage('unaries', n_regions=n_regions, n_objects=self.n_objects):
+            lut = self.get_intensity_lut()
+            if lut is not None:
+                table = self.beta * self.get_unary_table(lut)
+                unaries = regions.region_unaries_lut(region_ids, n_regions, lut.idx[self.nodes], table)
+            else:
+                if self.unaries is None:
+                    self.unaries = self.beta * self.get_unaries()
+                costs = self.unaries.reshape(-1, self.n_objects)[self.nodes, :]
+                unaries = regions.region_unaries(region_ids, n_regions, costs)
+
+        if self.pairwise is None:
+            with self._stage('pairwise'):
+                self.set_pairwise()
+
+        with self._stage('edges', n_regions=n_regions) as stage:
+            self.edges = regions.region_adjacency(region_ids, self.nodes, self.img.shape)
+            stage.set(n_edges=self.edges.shape[0])
+
+        with self._stage('graph_cut', n_nodes=n_regions, n_edges=self.edges.shape[0]) as stage:
+            result = solvers.solve(self.edges, unaries, self.pairwise, method=solver,
+                                   n_iter=self.params['solver_iter'], tol=self.params['solver_tol'])
+            self.energy = result.energy
+            stage.set(solver=solver, energy=self.energy)
+            # the labels of the regions are projected back to their voxels
+            self.labels = grid_graph.scatter_labels(result.labels[region_ids], self.nodes, self.img.shape,
+                                                    bgd_label=self.get_bgd_label(), dtype=np.int32,
+                                                    out=self._buffer('labels', self.img.shape, np.int32))
+
+        self._rescale_labels(resize)
+
+        self._debug('----------', True)
+        self._debug('segmentation done', True)
+
+        return self.labels_orig
+
+    def apply_plan(self, budget=None):
+        '''
+        Choose the execution strategy fitting the memory budget and set the parameters realizing it.
+        :param budget: memory budget in bytes or as a string with a unit (e.g. '4G'), defaults to params['memory_budget']
+        :return: planner.MemoryPlan
+        :raise planner.MemoryBudgetError: if no strategy fits the budget
+        '''
+        with self._stage('plan', shape=self.img_orig.shape) as stage:
+            self.plan = planner.plan_field(self, budget)
+            stage.set(strategy=self.plan.strategy, peak=self.plan.peak)
+        self._debug(str(self.plan), True)
+        self.params.update(self.plan.overrides)
+        self.scale = self.params['scale']
+        return self.plan
+
+    def run_cached(self, resize=True, solver=None, out=None):
+        '''
+        Segmentation through the disk cache - the labels of a previous run with the same inputs and parameters are
+        loaded, otherwise the segmentation is run (caching its models and unaries) and its labels are stored.
+        :return: labels of the original shape
+        '''
+        key = self.cache_key('labels', resize, solver)
+        with self._stage('cache', shape=self.img_orig.shape) as stage:
+            labels = self.disk_cache.load_array(key)
+            stage.set(hit=labels is not None)
+        if labels is not None:
+            # a writable copy, the labels are updated in place by update_seeds
+            self.labels_orig = np.array(labels, dtype=np.int32)
+            self.labels = self.labels_orig
+            self.energy = None
+            return self._store_labels(out)
+
+        self.cache_labels = False
+        try:
+            labels = self.run(resize=resize, solver=solver, out=out)
+        finally:
+            self.cache_labels = True
+        compact = _compact_dtype(labels.max()) if labels.size and labels.min() >= 0 else np.int32
+        self.disk_cache.save_array(key, labels.astype(compact))
+        return labels
+
+    def get_bgd_label(self):
+        '''
+        Label of the voxels outside the mask (or the crop box) - params['bgd_label'], 'auto' = n_objects, i.e. the first
+        label after those of the objects.
+        '''
+        bgd = self.params['bgd_label']
+        if bgd == 'auto':
+            return self.n_objects
+        return int(bgd)
+
+    def check_bgd_label(self):
+        '''
+        Warn if the voxels outside the mask (or the crop box) get a label of an object - the solver labels the objects
+        0 .. n_objects - 1, so the background label has to lie outside this range to tell the background apart.
+        :return: True if the background label is distinguishable
+        '''
+        bgd = self.get_bgd_label()
+        if (self.has_mask or self.params['crop']) and 0 <= bgd < self.n_objects:
+            warnings.warn('bgd_label %i is also the label of object %i, the voxels outside the mask cannot be told apart '
+                          'from it - set bgd_label outside 0 .. %i (e.g. to auto = n_objects).' % (bgd, bgd, self.n_objects - 1))
+            return False
+        return True
+
+    def _store_labels(self, out):
+        # labels of the original shape copied into the preallocated output of run
+        if out is not None and out is not self.labels_orig:
+            out[...] = self.labels_orig
+            if self.labels is self.labels_orig:
+                self.labels = out
+            self.labels_orig = out
+        return self.labels_orig
+
+    def run(self, resize=True, solver=None, out=None):
+        '''
+        Segmentation by the strategy selected by the parameters (memory plan, disk cache, crop, tiles, slices,
+        superpixels or the whole volume at once).
+        :param resize: if to segment at the scale self.scale
+        :param solver: defaults to params['solver']
+        :param out: optional preallocated labels of the original shape (e.g. np.memmap) - the tiled and cropped
+                    segmentations assemble their labels in it, the others copy them into it
+        :return: labels of the original shape
+        '''
+        if self.params['memory_budget'] and self.plan is None:
+            self.apply_plan()
+        self.check_bgd_label()
+        if self.disk_cache is None and self.params['cache_dir']:
+            self.disk_cache = result_cache.ResultCache(self.params['cache_dir'],
+                                                       planner.parse_size(self.params['cache_size']))
+        if self.disk_cache is not None and self.cache_labels:
+            return self.run_cached(resize=resize, solver=solver, out=out)
+        if self.params['crop']:
+            return self.run_cropped(resize=resize, solver=solver, out=out)
+        if 0 < self.params['tile_size'] < self.img_orig.shape[0]:
+            return self.run_tiled(resize=resize, solver=solver, out=out)
+        if self.params['per_slice']:
+            self.run_slices(resize=resize, solver=solver)
+            return self._store_labels(out)
+        if self.params['superpixels']:
+            self.run_regions(resize=resize, solver=solver)
+            return self._store_labels(out)
+
+        #----  rescaling  ----
+        self._rescale_input(resize)
+
         #----  calculating intensity models  ----
         # if self.unaries is None:
         if self.models is None:
-            self._debug('calculating intensity models ...', False)
-            # self.models = self.calc_intensity_models()
-            self.models = self.calc_models()
-            self._debug('done', True)
+            with self._stage('models', shape=self.img.shape):
+                # self.models = self.calc_intensity_models()
+                self.models = self.calc_models_cached()
 
         #----  creating unaries  ----
         if self.unaries is None:
-            self._debug('calculating unary potentials ...', False)
-            self.unaries = self.beta * self.get_unaries()
-            self._debug('done', True)
+            with self._stage('unaries', shape=self.img.shape, n_objects=self.n_objects) as stage:
+                self.unaries = self.get_unaries_cached()
+                stage.set(nbytes=self.unaries.nbytes)
 
         #----  create potts pairwise  ----
         if self.pairwise is None:
-            self._debug('calculating pairwise potentials ...', False)
-            # self.pairwise = - self.alpha * np.eye(self.n_objects, dtype=np.int32)
-            self.set_pairwise()
-            self._debug('done', True)
+            with self._stage('pairwise'):
+                # self.pairwise = - self.alpha * np.eye(self.n_objects, dtype=np.int32)
+                self.set_pairwise()
 
         #----  deriving graph edges  ----
-        self._debug('deriving graph edges ...', False)
-        # use the gerneral graph algorithm
-        # first, we construct the grid graph
-        # inds = np.arange(self.n_rows * self.n_cols).reshape(self.img.shape)
-        # horz = np.c_[inds[:, :-1].ravel(), inds[:, 1:].ravel()]
-        # vert = np.c_[inds[:-1, :].ravel(), inds[1:, :].ravel()]
-        # self.edges = np.vstack([horz, vert]).astype(np.int32)
-        inds = np.arange(self.img.size).reshape(self.img.shape)
-        if self.img.ndim == 2:
-            horz = np.c_[inds[:, :-1].ravel(), inds[:, 1:].ravel()]
-            vert = np.c_[inds[:-1, :].ravel(), inds[1:, :].ravel()]
-            self.edges = np.vstack([horz, vert]).astype(np.int32)
-        elif self.img.ndim == 3:
-            horz = np.c_[inds[:, :, :-1].ravel(), inds[:, :, 1:].ravel()]
-            vert = np.c_[inds[:, :-1, :].ravel(), inds[:, 1:, :].ravel()]
-            dept = np.c_[inds[:-1, :, :].ravel(), inds[1:, :, :].ravel()]
-            self.edges = np.vstack([horz, vert, dept]).astype(np.int32)
-        # deleting edges with nodes outside the mask
-        nodes_in = np.ravel_multi_index(np.nonzero(self.mask), self.img.shape)
-        rows_inds = np.in1d(self.edges, nodes_in).reshape(self.edges.shape).sum(axis=1) == 2
-        self.edges = self.edges[rows_inds, :]
-        self._debug('done', True)
+        with self._stage('edges', shape=self.img.shape) as stage:
+            # only the voxels inside the mask are used as graph nodes, they are renumbered to consecutive ids and their
+            # neighbours are found directly from the shifted mask (full grids are reused from the grid cache)
+            self.edges, self.nodes = self._grid_edges(self.mask)
+            stage.set(n_nodes=self.nodes.size, n_edges=self.edges.shape[0])
 
         #----  calculating graph cut  ----
-        self._debug('calculating graph cut ...', False)
-        # we flatten the unaries
-        result_graph = pygco.cut_from_graph(self.edges, self.unaries.reshape(-1, self.n_objects), self.pairwise)
-        self.labels = result_graph.reshape(self.img.shape)
-        self._debug('done', True)
+        with self._stage('graph_cut', n_nodes=self.nodes.size, n_edges=self.edges.shape[0]) as stage:
+            # we flatten the unaries and pass only those of the nodes inside the mask
+            unaries_in = self.unaries.reshape(-1, self.n_objects)[self.nodes, :]
+            result_graph = self.solve(self.edges, unaries_in, self.nodes, self.img.shape, solver)
+            stage.set(solver=solver or self.params['solver'], energy=self.energy)
+            self.labels = grid_graph.scatter_labels(result_graph, self.nodes, self.img.shape,
+                                                    bgd_label=self.get_bgd_label(), dtype=np.int32,
+                                                    out=self._buffer('labels', self.img.shape, np.int32))
 
         #----  zooming to the original size  ----
-        if resize and self.scale != 0:
-            # self.labels_orig = cv2.resize(self.labels, (0,0),  fx=1. / self.scale, fy= 1. / self.scale, interpolation=cv2.INTER_NEAREST)
-            self.labels_orig = tools.resize3D(self.labels, 1. / self.scale, sliceId=0)
-        else:
-            self.labels_orig = self.labels
+        self._rescale_labels(resize)
+
+        #----  re-solving the boundaries at the original size  ----
+        if resize and 0 < self.scale < 1 and self.params['refine_band'] > 0:
+            self.refine_boundaries()
 
         self._debug('----------', True)
         self._debug('segmentation done', True)
@@ -465,12 +1450,16 @@ class MarkovRandomField:
         # plt.subplot(224), plt.imshow(skiseg.mark_boundaries(self.img_orig, self.labels), interpolation='nearest'), plt.title('segmentation')
         # plt.show()
 
-        return self.labels_orig
+        return self._store_labels(out)
 
 
 #-----------------------------------------------------------------------------------------------------
 #-----------------------------------------------------------------------------------------------------
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    import skimage.data as skidat
+    import skimage.segmentation as skiseg
+
     # loading the image
     img = skidat.camera()
     n_rows, n_cols = img.shape
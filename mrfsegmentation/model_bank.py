@@ -0,0 +1,95 @@
+'''
+Persistent bank of intensity models.
+
+The models fitted to the volumes of a known protocol (e.g. by calc_models_hydohy) are stored as named sets in one
+.npz file and used instead of the per-volume estimation. A loaded set can be adapted to a volume by a cheap shift of
+all its means - the mean shift of the reference model on a subsampled histogram.
+'''
+from __future__ import division
+
+__author__ = 'tomas'
+
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+import histogram
+from color_model import pack_models, unpack_models
+
+
+def load_bank(path):
+    '''
+    :return: OrderedDict name -> list of ColorModels
+    '''
+    bank = OrderedDict()
+    with np.load(path) as data:
+        for key in sorted(data.files):
+            if key.startswith('values_'):
+                name = key[len('values_'):]
+                bank[name] = unpack_models(data[key], data['types_' + name])
+    return bank
+
+
+def save_bank(path, bank):
+    '''
+    Write a bank of model sets, the file is replaced atomically.
+    :param bank: dict name -> list of ColorModels
+    '''
+    arrays = dict()
+    for name, models in bank.items():
+        arrays['values_' + name], arrays['types_' + name] = pack_models(models)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_models(path, models, name='default'):
+    '''
+    Add a model set to a bank file (created if it does not exist), a set of the same name is replaced.
+    '''
+    bank = load_bank(path) if os.path.exists(path) else OrderedDict()
+    bank[name] = list(models)
+    save_bank(path, bank)
+
+
+def load_models(path, name='default'):
+    '''
+    :return: list of ColorModels of the set
+    :raise KeyError: if the bank has no such set
+    '''
+    bank = load_bank(path)
+    if name not in bank:
+        raise KeyError('Model bank %s has no model set %s (sets: %s).' % (path, name, ', '.join(bank) or '-'))
+    return bank[name]
+
+
+def adapt_models(models, hist, x, ref=None, n_iter=20):
+    '''
+    Shift all the models by the displacement of the mode of the reference model.
+    The mode is searched by mean shift starting at the mean of the reference model with its sigma as the bandwidth,
+    the sigmas, types and max_vals of the models are kept.
+    :param models: list of ColorModels
+    :param hist: histogram counts of the volume (may be subsampled)
+    :param x: bin centers
+    :param ref: index of the reference model, defaults to the model whose mean is the closest to the histogram peak
+    :param n_iter: maximal number of mean shift iterations
+    :return: (shifted models, shift)
+    '''
+    if len(hist) == 0:
+        return list(models), 0
+    if ref is None:
+        peak = x[np.argmax(hist)]
+        ref = int(np.argmin([abs(m.mean - peak) for m in models]))
+    mode = histogram.mean_shift(hist, x, models[ref].mean, models[ref].sigma, n_iter=n_iter)
+    shift = mode - models[ref].mean
+    values, types = pack_models(models)
+    values[:, 0] += shift
+    return unpack_models(values, types), shift
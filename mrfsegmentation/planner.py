@@ -0,0 +1,233 @@
+from __future__ import division
+
+__author__ = 'tomas'
+
+from collections import OrderedDict
+
+import numpy as np
+
+import resample
+
+# conservative estimates of the memory of gco per node and per edge (data costs, neighbour lists and the max-flow
+# graph of one expansion move)
+GCO_NODE_BYTES = 96
+GCO_EDGE_BYTES = 112
+
+# temporaries of the approximate solvers per node and label (costs and neighbour label counts in float64)
+APPROX_NODE_LABEL_BYTES = 24
+
+# scales tried when the configured one does not fit
+FALLBACK_SCALES = (0.5, 0.25, 0.125)
+
+_UNITS = {'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30, 't': 2 ** 40}
+
+
+class MemoryBudgetError(MemoryError):
+    '''
+    No execution strategy fits the memory budget.
+    '''
+    pass
+
+
+def parse_size(size):
+    '''
+    Memory size in bytes from a number or a string with a unit suffix (e.g. '512M', '4G').
+    '''
+    if isinstance(size, str):
+        size = size.strip().lower().rstrip('b')
+        if size and size[-1] in _UNITS:
+            return int(float(size[:-1]) * _UNITS[size[-1]])
+        return int(float(size))
+    return int(size)
+
+
+def format_size(n_bytes):
+    for unit, factor in (('G', 2 ** 30), ('M', 2 ** 20), ('k', 2 ** 10)):
+        if n_bytes >= factor:
+            return '%.1f %sB' % (n_bytes / factor, unit)
+    return '%i B' % n_bytes
+
+
+def _n_edges(n_nodes, shape):
+    # expected number of grid edges between n_nodes voxels of a grid, every axis contributes n * (s - 1) / s edges
+    return int(sum(n_nodes * (s - 1) / s for s in shape if s > 0))
+
+
+def estimate_stages(shape, n_nodes, n_objects, params, itemsize=1, scale=0, lean=False, solver='pygco'):
+    '''
+    Estimate the memory of the stages of MarkovRandomField.run for one (sub-)volume.
+    Every stage is described by the bytes it allocates temporarily and the bytes it keeps (the attributes of the
+    field), the peak of a stage is the sum of the kept bytes of the previous stages and its own allocations.
+    :param shape: shape of the (original) volume
+    :param n_nodes: number of voxels in the mask at the original resolution
+    :param n_objects: number of labels
+    :param itemsize: bytes per voxel of the image
+    :param scale: in-plane scale of the working volume (0 = none)
+    :param lean: if the lean mode is used (no input copies, compact unaries)
+    :param solver: solver of the labelling
+    :return: OrderedDict stage -> (transient bytes, kept bytes)
+    '''
+    n_orig = int(np.prod(shape))
+    if scale:
+        shape_w = resample.scaled_shape(shape, scale)
+        n_nodes = int(np.ceil(n_nodes * np.prod(shape_w) / n_orig))
+    else:
+        shape_w = tuple(shape)
+    n_vox = int(np.prod(shape_w))
+    n_edges = _n_edges(n_nodes, shape_w)
+    k = n_objects
+    beta = params['beta']
+
+    stages = OrderedDict()
+    # working copies of the image, seeds and mask (views in the lean mode and for memory-mapped inputs)
+    copies = 0 if lean else n_orig * (2 * itemsize + 1)
+    stages['input'] = (0, copies)
+    if scale:
+        # float64 block sums after the reduction of the first axis and the resampled image, seeds and mask
+        mid = shape[0] * shape_w[1] * shape[2] * 8
+        stages['rescale'] = (mid + n_vox * 8, n_vox * (2 * itemsize + 1))
+    idx_bytes = 1 if itemsize == 1 else 2
+    stages['models'] = (n_vox // max(1, shape_w[0]) * 8 * 8, n_vox * idx_bytes)
+    if lean:
+        # compact unaries of the smallest dtype holding 255 * beta
+        u_bytes = 1 if 255 * beta < 2 ** 8 else (2 if 255 * beta < 2 ** 16 else 4)
+        stages['unaries'] = (0, n_vox * k * u_bytes)
+    else:
+        # gathered table and its beta-weighted copy
+        stages['unaries'] = (n_vox * k * 4, n_vox * k * 4)
+    # boolean mask, node ids, per-axis neighbour tests and the stacked edge pairs
+    stages['edges'] = (n_vox * (1 + 4 + 1) + n_edges * 8 * 2, n_edges * 8 + n_nodes * 8)
+    if solver == 'pygco':
+        solve = n_nodes * (k * 4 * 2 + GCO_NODE_BYTES) + n_edges * GCO_EDGE_BYTES
+    else:
+        solve = n_nodes * k * (4 + APPROX_NODE_LABEL_BYTES) + n_edges * 8 * 2
+    stages['graph_cut'] = (solve + n_nodes * 4, n_vox * 4)
+    if scale:
+        stages['rescale_labels'] = (0, n_orig * 4)
+    return stages
+
+
+def stages_peak(stages, baseline=0):
+    '''
+    Peak memory of a sequence of stages.
+    :return: peak bytes, name of the stage reaching the peak
+    '''
+    kept = baseline
+    peak = baseline
+    peak_stage = None
+    for name, (transient, keep) in stages.items():
+        if kept + transient + keep > peak:
+            peak = kept + transient + keep
+            peak_stage = name
+        kept += keep
+    return peak, peak_stage
+
+
+class MemoryPlan():
+    '''
+    Execution strategy chosen for a memory budget with the estimates of all the considered strategies.
+    '''
+
+    def __init__(self, strategy, overrides, stages, peak, peak_stage, budget, candidates):
+        self.strategy = strategy  # name of the chosen strategy
+        self.overrides = overrides  # parameters realizing the strategy
+        self.stages = stages  # estimates of the stages of the strategy
+        self.peak = peak
+        self.peak_stage = peak_stage
+        self.budget = budget
+        self.candidates = candidates  # list of (strategy, overrides, peak) of all the considered strategies
+
+    def __str__(self):
+        lines = ['memory plan: %s %s, peak %s (%s) of budget %s' % (self.strategy, self.overrides or '',
+                                                                   format_size(self.peak), self.peak_stage,
+                                                                   format_size(self.budget))]
+        for name, (transient, keep) in self.stages.items():
+            lines.append('  %-16s transient %10s  kept %10s' % (name, format_size(transient), format_size(keep)))
+        lines.append('  considered: %s' % ', '.join('%s %s' % (name, format_size(peak))
+                                                    for name, _, peak in self.candidates))
+        return '\n'.join(lines)
+
+
+def plan(shape, slice_nodes, n_objects, params, budget, itemsize=1, roi=None, resident=True, lean=False,
+         labels_itemsize=4):
+    '''
+    Pick the first strategy fitting the budget in the order of decreasing quality: as configured, cropped to the
+    region of interest, tiled along the slices, scaled down (FALLBACK_SCALES) and cropped and scaled down.
+    :param shape: shape of the volume
+    :param slice_nodes: number of voxels in the mask of every slice
+    :param n_objects: number of labels
+    :param params: parameters of the segmentation
+    :param budget: memory budget in bytes
+    :param roi: region of interest (tuple of slices) or None
+    :param resident: if the inputs are loaded in memory (not memory-mapped), they count into the peak
+    :param lean: if the lean mode is used
+    :param labels_itemsize: bytes per voxel of the label volume assembled from the slabs
+    :return: MemoryPlan
+    :raise MemoryBudgetError: if no strategy fits
+    '''
+    budget = parse_size(budget)
+    slice_nodes = np.asarray(slice_nodes, dtype=np.int64)
+    n_orig = int(np.prod(shape))
+    baseline = n_orig * (2 * itemsize + 1) if resident else 0
+    solver = params['solver']
+    scale = params['scale']
+    candidates = []
+
+    def evaluate(name, overrides, sub_shape, n_nodes, sub_scale, extra=0):
+        stages = estimate_stages(sub_shape, n_nodes, n_objects, params, itemsize, sub_scale, lean, solver)
+        peak, peak_stage = stages_peak(stages, baseline + extra)
+        candidates.append((name, overrides, peak))
+        return MemoryPlan(name, overrides, stages, peak, peak_stage, budget, candidates)
+
+    def roi_nodes():
+        return int(slice_nodes[roi[0]].sum())
+
+    def options():
+        yield evaluate('configured', {}, shape, int(slice_nodes.sum()), scale)
+        if roi is not None:
+            roi_shape = tuple(s.stop - s.start for s in roi)
+            # the labels are pasted into a full-size volume
+            yield evaluate('cropped', {'crop': 1}, roi_shape, roi_nodes(), scale, n_orig * 4)
+        halo = params['tile_halo']
+        tile = shape[0] // 2
+        while tile >= 1:
+            sub_shape = (min(shape[0], tile + 2 * halo),) + tuple(shape[1:])
+            n_nodes = max(int(slice_nodes[max(0, start - halo):start + tile + halo].sum())
+                          for start in range(0, shape[0], tile))
+            yield evaluate('tiled', {'tile_size': tile}, sub_shape, n_nodes, scale, n_orig * labels_itemsize)
+            tile //= 2
+        for s in FALLBACK_SCALES:
+            if scale and s >= scale:
+                continue
+            yield evaluate('scaled', {'scale': s}, shape, int(slice_nodes.sum()), s)
+            if roi is not None:
+                roi_shape = tuple(sl.stop - sl.start for sl in roi)
+                yield evaluate('cropped_scaled', {'crop': 1, 'scale': s}, roi_shape, roi_nodes(), s, n_orig * 4)
+
+    for option in options():
+        if option.peak <= budget:
+            return option
+    raise MemoryBudgetError('No execution strategy fits the memory budget of %s, the smallest estimated peak is %s '
+                            '(%s).' % (format_size(budget), format_size(min(p for _, _, p in candidates)),
+                                       ', '.join('%s %s: %s' % (name, o or '', format_size(p))
+                                                 for name, o, p in candidates)))
+
+
+def plan_field(mrf, budget=None):
+    '''
+    Plan the segmentation of a field (MarkovRandomField) before any of its stages is run.
+    :param budget: memory budget, defaults to params['memory_budget']
+    :return: MemoryPlan
+    '''
+    if budget is None:
+        budget = mrf.params['memory_budget']
+    mask = mrf.mask_orig
+    shape = mrf.img_orig.shape
+    if all(st == 0 for st in mask.strides):
+        slice_nodes = np.zeros(shape[0], dtype=np.int64) + (int(shape[1] * shape[2]) if mask.flat[0] else 0)
+    else:
+        slice_nodes = np.array([np.count_nonzero(mask[i]) for i in range(shape[0])], dtype=np.int64)
+    roi = mrf.get_roi()
+    resident = not isinstance(mrf.img_orig, np.memmap)
+    return plan(shape, slice_nodes, mrf.n_objects, mrf.params, budget, itemsize=mrf.img_orig.dtype.itemsize, roi=roi,
+                resident=resident, lean=mrf.lean, labels_itemsize=np.dtype(mrf.label_dtype()).itemsize)
@@ -0,0 +1,146 @@
+from __future__ import division
+
+__author__ = 'tomas'
+
+import numpy as np
+
+import grid_graph
+
+def _grid_step(shape, n_segments):
+    # step of a regular grid of about n_segments cells
+    step = (np.prod(shape) / max(1, n_segments)) ** (1. / len(shape))
+    return max(1, int(round(step)))
+
+
+def grid_regions(shape, n_segments):
+    '''
+    Regular over-segmentation into blocks of (about) equal size.
+    :return: int32 region labels of the given shape
+    '''
+    step = _grid_step(shape, n_segments)
+    n_cells = [int(np.ceil(s / step)) for s in shape]
+    coords = np.ix_(*[np.arange(s) // step for s in shape])
+    regions = np.zeros(shape, dtype=np.int32)
+    for c, n in zip(coords, np.cumprod([1] + n_cells[::-1])[:-1][::-1]):
+        regions += (c * n).astype(np.int32)
+    return regions
+
+
+def _watershed(img, n_segments, compactness):
+    # compact watershed of the gradient magnitude seeded at a regular grid
+    try:
+        from skimage.segmentation import watershed
+    except ImportError:  # skimage < 0.16
+        from skimage.morphology import watershed
+    import scipy.ndimage as scindi
+    img = img.astype(np.float64)
+    gradient = np.zeros(img.shape)
+    for axis in range(img.ndim):
+        gradient += scindi.sobel(img, axis=axis) ** 2
+    step = _grid_step(img.shape, n_segments)
+    markers = np.zeros(img.shape, dtype=np.int32)
+    centers = tuple(slice(step // 2, None, step) for _ in img.shape)
+    markers[centers] = np.arange(1, markers[centers].size + 1).reshape(markers[centers].shape)
+    return watershed(np.sqrt(gradient), markers, compactness=compactness)
+
+
+def _slic(img, n_segments, compactness):
+    from skimage.segmentation import slic
+    img = img.astype(np.float64)
+    try:
+        return slic(img, n_segments=n_segments, compactness=compactness, multichannel=False)
+    except TypeError:  # skimage >= 0.19 has no multichannel argument
+        return slic(img, n_segments=n_segments, compactness=compactness, channel_axis=None)
+
+
+def supervoxels(img, n_segments, method='slic', compactness=10):
+    '''
+    Over-segment a volume into supervoxels.
+    :param img: 3D image
+    :param n_segments: approximate number of the supervoxels
+    :param method: 'slic', 'watershed' (compact watershed of the gradient) or 'grid' (regular blocks), skimage is
+                   imported only by slic and watershed
+    :param compactness: balance of the intensity similarity and the spatial proximity of slic and watershed
+    :return: region labels of the shape of the image
+    '''
+    if method == 'slic':
+        return _slic(img, n_segments, compactness)
+    elif method == 'watershed':
+        return _watershed(img, n_segments, compactness)
+    elif method == 'grid':
+        return grid_regions(img.shape, n_segments)
+    raise ValueError('Unknown over-segmentation method: %s' % method)
+
+
+def mask_regions(regions, mask):
+    '''
+    Renumber the regions restricted to the mask.
+    :param regions: region labels
+    :param mask: boolean (or nonzero-valued) array of the same shape
+    :return: (region_ids, flat_inds, n_regions) - consecutive ids of the in-mask voxels in the order of flat_inds
+    '''
+    flat_inds = np.flatnonzero(np.asarray(mask) != 0)
+    labels = np.asarray(regions).ravel()[flat_inds]
+    _, region_ids = np.unique(labels, return_inverse=True)
+    region_ids = region_ids.astype(np.int32)
+    n_regions = int(region_ids.max()) + 1 if region_ids.size else 0
+    return region_ids, flat_inds, n_regions
+
+
+def region_adjacency(region_ids, flat_inds, shape):
+    '''
+    Region adjacency graph weighted by the boundary lengths.
+    The weight of an edge is the number of neighbouring voxel pairs (grid edges) between the two regions, so the Potts
+    cost of the graph equals the Potts cost of the voxel grid labelled by the regions.
+    :param region_ids: ids of the in-mask voxels as returned by mask_regions
+    :param flat_inds: raveled indices of the in-mask voxels
+    :param shape: shape of the volume
+    :return: (n_edges, 3) int32 array of region pairs and boundary lengths
+    '''
+    mask = np.zeros(shape, dtype=np.bool_)
+    mask.flat[flat_inds] = True
+    edges, _ = grid_graph.masked_grid_edges(mask)
+    a = region_ids[edges[:, 0]].astype(np.int64)
+    b = region_ids[edges[:, 1]].astype(np.int64)
+    del edges
+    cross = a != b
+    a, b = np.minimum(a[cross], b[cross]), np.maximum(a[cross], b[cross])
+    n_regions = int(region_ids.max()) + 1 if region_ids.size else 0
+    pairs, lengths = np.unique(a * n_regions + b, return_counts=True)
+    return np.c_[pairs // n_regions, pairs % n_regions, lengths].astype(np.int32)
+
+
+def region_unaries(region_ids, n_regions, costs):
+    '''
+    Unaries of the regions - sums of the unary costs of their voxels.
+    :param region_ids: ids of the in-mask voxels
+    :param costs: (n_voxels, n_objects) costs of the in-mask voxels
+    :return: int32 unaries (n_regions, n_objects)
+    '''
+    unaries = np.empty((n_regions, costs.shape[1]), dtype=np.int64)
+    for k in range(costs.shape[1]):
+        unaries[:, k] = np.bincount(region_ids, weights=costs[:, k], minlength=n_regions).round()
+    return _to_int32(unaries)
+
+
+def region_unaries_lut(region_ids, n_regions, idx, table):
+    '''
+    Unaries of the regions from tabulated costs, the per-voxel costs are gathered one object at a time so that the full
+    (n_voxels, n_objects) array is never materialized.
+    :param region_ids: ids of the in-mask voxels
+    :param idx: lookup table indices of the in-mask voxels
+    :param table: (n_values, n_objects) costs of the intensities
+    :return: int32 unaries (n_regions, n_objects)
+    '''
+    unaries = np.empty((n_regions, table.shape[1]), dtype=np.int64)
+    for k in range(table.shape[1]):
+        unaries[:, k] = np.bincount(region_ids, weights=table[idx, k], minlength=n_regions).round()
+    return _to_int32(unaries)
+
+
+def _to_int32(unaries):
+    # the solver works with int32 costs, the energy of the whole graph has to fit as well
+    top = np.abs(unaries).max() if unaries.size else 0
+    if top > np.iinfo(np.int32).max // 2:
+        raise ValueError('Unaries of the regions overflow int32, use smaller supervoxels.')
+    return unaries.astype(np.int32)
@@ -0,0 +1,95 @@
+from __future__ import division
+
+__author__ = 'tomas'
+
+import numpy as np
+
+# in-plane axes of the (slices, rows, cols) volumes, the slice axis is never resampled
+PLANE_AXES = (1, 2)
+
+
+def scaled_shape(shape, scale):
+    '''
+    Shape of a volume resampled in-plane by the given scale.
+    :return: tuple (n_slices, round(n_rows * scale), round(n_cols * scale)), in-plane sizes are at least 1
+    '''
+    shape = list(shape)
+    for axis in PLANE_AXES:
+        shape[axis] = max(1, int(round(shape[axis] * scale)))
+    return tuple(shape)
+
+
+def scaled_coords(coords, shape_in, shape_out):
+    '''
+    Map voxel coordinates to the grid of a resampled volume, a voxel falls into the bin covering it.
+    :param coords: (n, ndim) integer coordinates in the grid of the shape shape_in
+    :return: (n, ndim) coordinates in the grid of the shape shape_out
+    '''
+    coords = np.array(coords, dtype=np.intp).reshape(-1, len(shape_in))
+    for axis in PLANE_AXES:
+        coords[:, axis] = coords[:, axis] * shape_out[axis] // shape_in[axis]
+    return coords
+
+
+def _bin_starts(n_in, n_out):
+    # first input index of every output bin, input index i falls into the bin floor(i * n_out / n_in)
+    return np.ceil(np.arange(n_out) * n_in / n_out).astype(np.intp)
+
+
+def _reduce(data, shape_out, ufunc, dtype=None):
+    # vectorized reduction of consecutive bins along the in-plane axes
+    for axis in PLANE_AXES:
+        starts = _bin_starts(data.shape[axis], shape_out[axis])
+        data = ufunc.reduceat(data, starts, axis=axis, dtype=dtype)
+    return data
+
+
+def downsample_mean(img, scale):
+    '''
+    Area (block mean) downsampling of intensities.
+    Every output voxel is the mean of the input voxels falling into it, integer images keep their dtype (rounded).
+    :param img: 3D volume (slices, rows, cols)
+    :param scale: scaling factor of the rows and cols, scales >= 1 fall back to upsample_nearest
+    :return: resampled volume of the shape scaled_shape(img.shape, scale)
+    '''
+    img = np.asarray(img)
+    shape_out = scaled_shape(img.shape, scale)
+    if scale >= 1:
+        return upsample_nearest(img, shape_out)
+    sums = _reduce(img, shape_out, np.add, dtype=np.float64)
+    counts = np.ones(1)
+    for axis in PLANE_AXES:
+        c = np.diff(np.r_[_bin_starts(img.shape[axis], shape_out[axis]), img.shape[axis]])
+        counts = counts * c.reshape([-1 if a == axis else 1 for a in range(img.ndim)])
+    sums /= counts
+    if np.issubdtype(img.dtype, np.integer) or img.dtype == np.bool_:
+        return np.round(sums).astype(img.dtype)
+    return sums.astype(img.dtype)
+
+
+def downsample_max(data, scale):
+    '''
+    Max pooling of labels (seeds, masks) - a nonzero voxel marks the whole output voxel, sparse seeds are not lost.
+    :param data: 3D volume (slices, rows, cols)
+    :param scale: scaling factor of the rows and cols, scales >= 1 fall back to upsample_nearest
+    :return: resampled volume of the shape scaled_shape(data.shape, scale)
+    '''
+    data = np.asarray(data)
+    if scale >= 1:
+        return upsample_nearest(data, scaled_shape(data.shape, scale))
+    return _reduce(data, scaled_shape(data.shape, scale), np.maximum)
+
+
+def upsample_nearest(labels, shape):
+    '''
+    Nearest-neighbour upsampling of labels by index repetition to an exact shape.
+    :param labels: 3D volume (slices, rows, cols)
+    :param shape: target shape, the number of slices has to be the same
+    :return: volume of the given shape
+    '''
+    if labels.shape[0] != shape[0]:
+        raise ValueError('The number of slices cannot be changed.')
+    idx = [np.arange(shape[0])]
+    for axis in PLANE_AXES:
+        idx.append(np.arange(shape[axis]) * labels.shape[axis] // shape[axis])
+    return labels[np.ix_(*idx)]
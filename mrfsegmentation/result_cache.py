@@ -0,0 +1,212 @@
+'''
+Content-addressed on-disk cache of the stages of segmentations.
+
+The entries are keyed by a digest of the input image, seeds and mask and of only the parameters the cached stage
+depends on (STAGE_PARAMS), so e.g. a rerun with a different alpha reuses the cached models and unaries and solves the
+graph only. Several processes may share one cache directory - the entries are written to temporary files renamed
+into place and a vanished entry is treated as a miss.
+'''
+from __future__ import division
+
+__author__ = 'tomas'
+
+import errno
+import hashlib
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from color_model import pack_models, unpack_models
+
+# default size cap of a cache directory
+CACHE_BYTES = 4 * 2 ** 30
+
+# temporary files older than this (in seconds) are left over by crashed writers and are removed by the eviction
+STALE_TMP_SECONDS = 3600
+
+# parameters invalidating the stages of the segmentation, every stage depends on its own parameters and on those of
+# the stages it is computed from:
+#   input (rescaled image, seeds and mask) -> models -> unaries, input -> edges, pairwise, (unaries, edges, pairwise)
+#   -> solve
+STAGE_PARAMS = [
+    ('input', ('scale',)),
+    ('models', ('perc', 'k_std_dom', 'k_std_hypo', 'domin_simple_estim', 'prob_w', 'hypo_mean_offset', 'hist_estim',
+                'hist_subsample', 'em_iter', 'em_tol', 'model_bank', 'model_set', 'model_adapt',
+                'model_adapt_subsample')),
+    ('unaries', ('beta', 'unaries_as_cdf', 'unaries_lut', 'lut_quant_step', 'lean')),
+    ('edges', ()),
+    ('pairwise', ('alpha',)),
+    ('solve', ('solver', 'solver_iter', 'solver_tol', 'bgd_label')),
+]
+
+STAGE_DEPENDENCIES = {
+    'input': (),
+    'models': ('input',),
+    'unaries': ('models',),
+    'edges': ('input',),
+    'pairwise': (),
+    'solve': ('unaries', 'edges', 'pairwise'),
+}
+
+# parameters selecting how MarkovRandomField.run computes the labels on top of those of the solve stage
+RUN_PARAMS = ('refine_band', 'crop', 'crop_margin', 'crop_seeds_margin', 'tile_size', 'tile_halo', 'per_slice',
+              'superpixels', 'superpixel_method', 'superpixel_size', 'superpixel_compactness', 'memory_budget')
+
+
+def stage_key(stage, params):
+    '''
+    Values of all the parameters a stage depends on, including the parameters of its upstream stages.
+    Two combinations with the same key share the result of the stage.
+    '''
+    stage_params = dict(STAGE_PARAMS)
+    key = tuple((p, params.get(p)) for p in stage_params[stage])
+    for dep in STAGE_DEPENDENCIES[stage]:
+        key += stage_key(dep, params)
+    return key
+
+
+def fingerprint(arr):
+    '''
+    Digest of the shape, dtype and data of an array (None for no array).
+    The data are hashed slice by slice so that memory-mapped volumes are never loaded at once, broadcast constants
+    (e.g. the implicit full mask) are hashed by their value.
+    '''
+    if arr is None:
+        return None
+    h = hashlib.sha1(('%s %s' % (tuple(arr.shape), arr.dtype.str)).encode('ascii'))
+    if arr.size and all(st == 0 for st in arr.strides):
+        h.update(('constant %r' % arr[(0,) * arr.ndim]).encode('ascii'))
+    else:
+        for part in (arr if arr.ndim > 1 else [arr]):
+            h.update(np.ascontiguousarray(part))
+    return h.hexdigest()
+
+
+def models_key(models):
+    # the models enter the keys by their parameters, an int and a float mean of the same value give the same key
+    values, types = pack_models(models)
+    return tuple(values.ravel().tolist()), tuple(types.tolist())
+
+
+def digest(*parts):
+    '''
+    Cache key of a tuple of hashable values (strings, numbers and nested tuples of them).
+    '''
+    return hashlib.sha1(repr(parts).encode('ascii')).hexdigest()
+
+
+class ResultCache():
+    '''
+    Size-bounded on-disk cache of fitted models, unary stacks and labels.
+    Every entry is one file named by its key. The modification times of the entries are the LRU order - they are
+    refreshed on every hit and the oldest entries are removed when a write exceeds max_bytes. Memory-mapped unaries
+    stay valid even if their entry is evicted by another process in the meantime (POSIX).
+    '''
+
+    def __init__(self, path, max_bytes=CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def _open(self, path, load):
+        # load an entry and refresh its position in the LRU order, None if there is no such entry
+        try:
+            os.utime(path, None)
+            value = load(path)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def _write(self, path, save):
+        # the entry appears atomically, a concurrent writer of the same key writes the same content
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                save(f)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def load_models(self, key):
+        '''
+        :return: list of ColorModels, None on a miss
+        '''
+        def load(path):
+            with np.load(path) as data:
+                return unpack_models(data['values'], data['types'])
+        return self._open(self._file(key, '.models.npz'), load)
+
+    def save_models(self, key, models):
+        values, types = pack_models(models)
+        self._write(self._file(key, '.models.npz'), lambda f: np.savez(f, values=values, types=types))
+
+    def load_array(self, key, mmap=True):
+        '''
+        :param mmap: if to memory-map the array read-only instead of loading it
+        :return: array, None on a miss
+        '''
+        return self._open(self._file(key, '.npy'), lambda path: np.load(path, mmap_mode='r' if mmap else None))
+
+    def save_array(self, key, arr):
+        self._write(self._file(key, '.npy'), lambda f: np.save(f, np.asarray(arr)))
+
+    def entries(self):
+        '''
+        :return: list of (mtime, size, path) of the entries, oldest first
+        '''
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:  # removed by another process
+                continue
+            if name.endswith('.tmp'):
+                if time.time() - st.st_mtime > STALE_TMP_SECONDS:
+                    self._remove(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:  # already evicted by another process
+            pass
+
+    @property
+    def nbytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits max_bytes.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            self._remove(path)
@@ -0,0 +1,253 @@
+'''
+Asynchronous segmentation scheduler for event-loop applications (e.g. a web service).
+
+The jobs are segmented in a bounded pool of worker threads and their labels are delivered through asyncio futures.
+Every job reports the stages of its segmentation (plan, rescale, models, unaries, edges, graph_cut, rescale_labels, ...)
+as Progress events on the event loop, and a cancelled job stops at the start of its next stage. The jobs are admitted
+in the order of submission while the sum of their estimated peak memory (see planner) fits the memory limit, so large
+volumes wait in the queue instead of exhausting the host. The fields are created and their memory is estimated in a
+separate thread, the event loop never passes over the volumes.
+
+The scheduler works with callbacks only, the futures can be awaited by coroutines of both asyncio and trollius:
+
+    scheduler = Scheduler(max_workers=2, memory_limit='8G')
+    job = scheduler.submit(img, seeds, on_progress=report)
+    labels = loop.run_until_complete(job.future)
+'''
+__author__ = 'tomas'
+
+import itertools
+import sys
+from collections import deque, namedtuple
+
+import concurrent.futures as confut
+
+try:
+    import asyncio
+except ImportError:  # python 2
+    import trollius as asyncio
+
+import planner
+from markov_random_field import MarkovRandomField
+
+# progress of a job delivered on the event loop - the start and end of the stages of its segmentation (info as in
+# instrumentation.StageEvent) and the changes of its state with stage 'job' and phase 'queued', 'running', 'done',
+# 'failed' or 'cancelled' (a job is 'estimating' before it is queued)
+Progress = namedtuple('Progress', ['job_id', 'stage', 'phase', 'info'])
+
+
+class JobCancelled(Exception):
+    '''
+    Raised in the worker of a cancelled job at the start of its next stage.
+    '''
+    pass
+
+
+class Job():
+    '''
+    Segmentation job of a Scheduler.
+    '''
+
+    def __init__(self, job_id, mrf, memory, future, on_progress=None):
+        self.id = job_id
+        self.mrf = mrf  # field of the job, released when the job finishes
+        self.memory = memory  # estimated peak memory in bytes
+        self.future = future  # asyncio future of the labels
+        self.on_progress = on_progress  # callable accepting Progress, called on the event loop
+        self.state = 'estimating'  # estimating, queued, running, done, failed or cancelled
+        self.stage = None  # stage the job is running
+        self.energy = None  # energy of the labelling of a finished job
+        self.cancel_requested = False
+
+    def cancel(self):
+        '''
+        Cancel the job - an estimating or queued job is dropped, a running one stops at the start of its next stage.
+        Has to be called from the event loop (the same as cancelling the future).
+        '''
+        self.cancel_requested = True
+        if not self.future.done():
+            self.future.cancel()
+
+
+class Scheduler():
+    '''
+    Bounded executor of segmentation jobs with awaitable results, progress events, cooperative cancellation and
+    admission weighted by the estimated memory of the jobs. All the methods have to be called from the event loop.
+    '''
+
+    def __init__(self, max_workers=2, memory_limit=None, params=None, config_path='config.ini', loop=None,
+                 **mrf_kwargs):
+        '''
+        :param max_workers: number of jobs segmented at once
+        :param memory_limit: limit of the summed estimated peak memory of the running jobs in bytes or with a unit
+                             (e.g. '8G'), None = the jobs are limited by max_workers only. A job estimated above the
+                             limit runs alone.
+        :param params: parsed parameters, loaded from config_path if not given
+        :param loop: event loop of the futures and the progress events, defaults to the current one
+        :param mrf_kwargs: arguments of MarkovRandomField used for every job (alpha, beta, scale, models_estim, ...)
+        '''
+        if params is None:
+            params = MarkovRandomField.load_parameters(config_path)
+        self.params = dict(params)
+        self.mrf_kwargs = mrf_kwargs
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.max_workers = max_workers
+        self.memory_limit = planner.parse_size(memory_limit) if memory_limit else None
+        self.executor = confut.ThreadPoolExecutor(max_workers)
+        # one thread creating the fields and estimating their memory, the jobs are queued in the order of submission
+        self.estimator = confut.ThreadPoolExecutor(1)
+        self.estimating = set()
+        self.queue = deque()
+        self.running = set()
+        self.memory_used = 0  # estimated memory of the running jobs
+        self._ids = itertools.count(1)
+
+    def field(self, img, seeds=None, mask=None, **kwargs):
+        # the fields work in the lean mode so that the queued jobs hold no copies of their inputs
+        mrf_kwargs = dict(self.mrf_kwargs)
+        mrf_kwargs.update(kwargs)
+        mrf_kwargs.setdefault('alpha', self.params['alpha'])
+        mrf_kwargs.setdefault('beta', self.params['beta'])
+        mrf_kwargs.setdefault('scale', self.params['scale'])
+        mrf_kwargs.setdefault('lean', True)
+        mrf_kwargs.setdefault('verbose', False)
+        return MarkovRandomField(img, seeds, mask=mask, params=self.params, **mrf_kwargs)
+
+    @staticmethod
+    def estimate(mrf):
+        '''
+        Estimated peak memory of the segmentation of a field. With params['memory_budget'] the execution strategy of
+        the field is planned for its budget, otherwise the configured strategy is estimated.
+        :raise planner.MemoryBudgetError: if no strategy fits the budget of the field
+        '''
+        if mrf.params['memory_budget']:
+            return mrf.apply_plan().peak
+        return planner.plan_field(mrf, budget=sys.maxsize).peak
+
+    def _new_future(self):
+        if hasattr(self.loop, 'create_future'):
+            return self.loop.create_future()
+        return asyncio.Future(loop=self.loop)
+
+    def submit(self, img, seeds=None, mask=None, on_progress=None, memory=None, **kwargs):
+        '''
+        Submit the segmentation of one image. The job is queued once its field is created and its memory estimated in
+        the estimator thread.
+        :param on_progress: callable accepting Progress events, called on the event loop
+        :param memory: estimated peak memory of the job in bytes or with a unit supplied by the caller, the planner
+                       estimate is skipped
+        :param kwargs: arguments of MarkovRandomField overriding those of the scheduler
+        :return: Job - its future gives the labels of the shape of the image
+        '''
+        job = Job(next(self._ids), None, 0, self._new_future(), on_progress)
+        job.future.add_done_callback(lambda future: self._on_done(job))
+        self.estimating.add(job)
+        self._notify(job, Progress(job.id, 'job', 'estimating', {}))
+        worker = self.estimator.submit(self._prepare, job, img, seeds, mask, memory, kwargs)
+        worker.add_done_callback(lambda w: self.loop.call_soon_threadsafe(self._admit, job, w))
+        return job
+
+    def _prepare(self, job, img, seeds, mask, memory, kwargs):
+        # runs in the estimator thread
+        if job.cancel_requested:
+            raise JobCancelled('Job %i cancelled.' % job.id)
+        mrf = self.field(img, seeds, mask, **kwargs)
+        if memory is None:
+            memory = self.estimate(mrf)
+        return mrf, planner.parse_size(memory)
+
+    def _admit(self, job, worker):
+        # queue an estimated job, a job whose estimate failed (e.g. planner.MemoryBudgetError) fails
+        self.estimating.discard(job)
+        error = worker.exception()
+        if job.future.cancelled() or isinstance(error, JobCancelled):
+            job.state = 'cancelled'
+            if not job.future.done():
+                job.future.cancel()
+            self._notify(job, Progress(job.id, 'job', 'cancelled', {}))
+            return
+        if error is not None:
+            job.state = 'failed'
+            job.future.set_exception(error)
+            self._notify(job, Progress(job.id, 'job', 'failed', {}))
+            return
+        job.mrf, job.memory = worker.result()
+        job.state = 'queued'
+        self.queue.append(job)
+        self._notify(job, Progress(job.id, 'job', 'queued', {'memory': job.memory}))
+        self._dispatch()
+
+    def _notify(self, job, progress):
+        if job.on_progress is not None:
+            job.on_progress(progress)
+
+    def _dispatch(self):
+        # start the queued jobs in order while they fit, the head of the queue is never overtaken
+        while self.queue and len(self.running) < self.max_workers:
+            job = self.queue[0]
+            if (self.running and self.memory_limit is not None and
+                    self.memory_used + job.memory > self.memory_limit):
+                break
+            self.queue.popleft()
+            self.running.add(job)
+            self.memory_used += job.memory
+            job.state = 'running'
+            self._notify(job, Progress(job.id, 'job', 'running', {'memory': job.memory}))
+            worker = self.executor.submit(self._run, job)
+            worker.add_done_callback(lambda w, job=job: self.loop.call_soon_threadsafe(self._finished, job, w))
+
+    def _run(self, job):
+        # runs in a worker thread, the stages report to the event loop and check the cancellation
+
+        def hook(event):
+            if event.phase == 'start':
+                if job.cancel_requested:
+                    raise JobCancelled('Job %i cancelled before stage %s.' % (job.id, event.stage))
+                job.stage = event.stage
+            self.loop.call_soon_threadsafe(self._notify, job, Progress(job.id, event.stage, event.phase, event.info))
+
+        if job.cancel_requested:
+            raise JobCancelled('Job %i cancelled.' % job.id)
+        job.mrf.add_hook(hook)
+        labels = job.mrf.run()
+        job.energy = job.mrf.energy
+        return labels
+
+    def _on_done(self, job):
+        # a cancelled future of a queued job removes the job, an estimating job is dropped when its estimate is done and
+        # a running job is stopped by its hook
+        if job.future.cancelled():
+            job.cancel_requested = True
+            if job in self.queue:
+                self.queue.remove(job)
+                job.state = 'cancelled'
+                job.mrf = None
+                self._notify(job, Progress(job.id, 'job', 'cancelled', {}))
+
+    def _finished(self, job, worker):
+        self.running.discard(job)
+        self.memory_used -= job.memory
+        job.mrf = None
+        job.stage = None
+        error = worker.exception()
+        if job.future.cancelled() or isinstance(error, JobCancelled):
+            job.state = 'cancelled'
+            if not job.future.done():
+                job.future.cancel()
+        elif error is not None:
+            job.state = 'failed'
+            job.future.set_exception(error)
+        else:
+            job.state = 'done'
+            job.future.set_result(worker.result())
+        self._notify(job, Progress(job.id, 'job', job.state, {}))
+        self._dispatch()
+
+    def shutdown(self, wait=True):
+        '''
+        Cancel all the estimating, queued and running jobs and stop the workers.
+        '''
+        for job in list(self.estimating) + list(self.queue) + list(self.running):
+            job.cancel()
+        self.estimator.shutdown(wait=wait)
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,191 @@
+__author__ = 'tomas'
+
+from collections import OrderedDict
+
+import numpy as np
+
+import grid_graph
+from markov_random_field import MarkovRandomField
+
+# default memory caps of the caches of a session
+GRID_CACHE_BYTES = 512 * 2 ** 20
+BUFFER_POOL_BYTES = 1024 * 2 ** 20
+
+
+class _LRUCache():
+    # size-bounded LRU mapping, the size of an item is given by the nbytes of its arrays
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.sizes = dict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def put(self, key, value, nbytes):
+        if key in self.items:
+            self.items.pop(key)
+            self.nbytes -= self.sizes.pop(key)
+        self.items[key] = value
+        self.sizes[key] = nbytes
+        self.nbytes += nbytes
+        # the newest item is kept even if it exceeds the cap by itself
+        while self.nbytes > self.max_bytes and len(self.items) > 1:
+            old_key, _ = self.items.popitem(last=False)
+            self.nbytes -= self.sizes.pop(old_key)
+
+    def clear(self):
+        self.items.clear()
+        self.sizes.clear()
+        self.nbytes = 0
+
+
+class GridCache(_LRUCache):
+    '''
+    LRU cache of full-grid topologies (edges, node indices and checkerboard colors) keyed by (shape, connectivity).
+    '''
+
+    def __init__(self, max_bytes=GRID_CACHE_BYTES):
+        _LRUCache.__init__(self, max_bytes)
+
+    def template(self, shape, connectivity=None):
+        '''
+        Topology of the full grid of the given shape.
+        :return: edges, nodes, colors
+        '''
+        key = (tuple(shape), connectivity)
+        topology = self.get(key)
+        if topology is None:
+            edges, nodes = grid_graph.masked_grid_edges(np.ones(shape, dtype=np.bool_), connectivity)
+            colors = grid_graph.node_parity(nodes, shape)
+            topology = (edges, nodes, colors)
+            self.put(key, topology, edges.nbytes + nodes.nbytes + colors.nbytes)
+        return topology
+
+    def masked_edges(self, mask, connectivity=None):
+        '''
+        Edges and nodes of the in-mask voxels, the cached template is used when the mask covers the whole grid.
+        :return: edges, nodes
+        '''
+        mask = np.asarray(mask)
+        full = all(st == 0 for st in mask.strides) and mask.flat[0] != 0 or np.all(mask)
+        if full:
+            edges, nodes, _ = self.template(mask.shape, connectivity)
+            return edges, nodes
+        return grid_graph.masked_grid_edges(mask, connectivity)
+
+    def colors(self, nodes, shape, connectivity=None):
+        # checkerboard colors of the nodes, cached for the full grid
+        key = (tuple(shape), connectivity)
+        if key in self.items and self.items[key][1].size == nodes.size:
+            return self.items[key][2]
+        return grid_graph.node_parity(nodes, shape)
+
+
+class BufferPool(_LRUCache):
+    '''
+    Preallocated arrays reused between segmentations, keyed by (name, shape, dtype).
+    '''
+
+    def __init__(self, max_bytes=BUFFER_POOL_BYTES):
+        _LRUCache.__init__(self, max_bytes)
+
+    def empty(self, name, shape, dtype):
+        key = (name, tuple(shape), np.dtype(dtype).str)
+        buf = self.get(key)
+        if buf is None:
+            buf = np.empty(shape, dtype=dtype)
+            self.put(key, buf, buf.nbytes)
+        return buf
+
+
+class Segmenter():
+    '''
+    Long-lived segmentation session.
+    The parameters are parsed once, the grid topologies are kept in an LRU cache and the unary and label arrays are
+    reused, so repeated segmentations of volumes of the same shape skip all the topology work and allocations.
+    The returned labels live in the reused buffers - they are overwritten by the next segmentation of the same shape
+    unless reuse_labels is False.
+    '''
+
+    def __init__(self, params=None, config_path='config.ini', grid_cache_bytes=GRID_CACHE_BYTES,
+                 buffer_bytes=BUFFER_POOL_BYTES, reuse_labels=True, **mrf_kwargs):
+        '''
+        :param params: parsed parameters, loaded from config_path if not given
+        :param mrf_kwargs: arguments of MarkovRandomField used for every image (alpha, beta, scale, models_estim, ...)
+        '''
+        if params is None:
+            params = MarkovRandomField.load_parameters(config_path)
+        self.params = dict(params)
+        self.mrf_kwargs = mrf_kwargs
+        self.grid_cache = GridCache(grid_cache_bytes)
+        self.buffers = BufferPool(buffer_bytes)
+        self.reuse_labels = reuse_labels
+        self.hooks = []
+        self.last = None  # field of the last segmentation
+
+    def add_hook(self, hook):
+        if hook not in self.hooks:
+            self.hooks.append(hook)
+
+    def field(self, img, seeds=None, mask=None, **kwargs):
+        '''
+        Create a field sharing the parameters, caches and buffers of the session.
+        :param kwargs: arguments of MarkovRandomField overriding those of the session
+        '''
+        mrf_kwargs = dict(self.mrf_kwargs)
+        mrf_kwargs.update(kwargs)
+        mrf_kwargs.setdefault('alpha', self.params['alpha'])
+        mrf_kwargs.setdefault('beta', self.params['beta'])
+        mrf_kwargs.setdefault('scale', self.params['scale'])
+        mrf_kwargs.setdefault('lean', True)
+        mrf_kwargs.setdefault('verbose', False)
+        mrf = MarkovRandomField(img, seeds, mask=mask, params=self.params, **mrf_kwargs)
+        mrf.grid_cache = self.grid_cache
+        mrf.buffer_pool = self.buffers if self.reuse_labels else _UnaryBuffers(self.buffers)
+        for hook in self.hooks:
+            mrf.add_hook(hook)
+        return mrf
+
+    def segment(self, img, seeds=None, mask=None, **kwargs):
+        '''
+        Segment one image.
+        :return: labels of the shape of the image
+        '''
+        self.last = self.field(img, seeds, mask, **kwargs)
+        return self.last.run()
+
+    def stream(self, images):
+        '''
+        Segment a stream of images.
+        :param images: iterable of images or of tuples (img, seeds, mask)
+        :return: generator of labels
+        '''
+        for item in images:
+            if isinstance(item, tuple):
+                item = tuple(item) + (None,) * (3 - len(item))
+                yield self.segment(*item[:3])
+            else:
+                yield self.segment(item)
+
+
+class _UnaryBuffers():
+    # buffer pool reusing the unaries only, the labels are allocated for every segmentation
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def empty(self, name, shape, dtype):
+        if name == 'labels':
+            return np.empty(shape, dtype=dtype)
+        return self.pool.empty(name, shape, dtype)
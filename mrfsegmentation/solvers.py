@@ -0,0 +1,239 @@
+from __future__ import division
+
+__author__ = 'tomas'
+
+from collections import namedtuple
+
+import numpy as np
+
+import grid_graph
+
+# labels of the nodes, energy of the labelling and number of performed iterations (None if unknown)
+SolverResult = namedtuple('SolverResult', ['labels', 'energy', 'n_iter'])
+
+
+def energy(edges, unaries, pairwise, labels):
+    '''
+    Energy of a labelling - sum of the unary costs of the labels and the pairwise costs over the edges.
+    :param edges: (n_edges, 2) node pairs or (n_edges, 3) node pairs with edge weights
+    :param unaries: (n_nodes, n_labels) unary costs
+    :param pairwise: (n_labels, n_labels) pairwise costs
+    :param labels: (n_nodes,) labels
+    :return: energy
+    '''
+    e = unaries[np.arange(labels.size), labels].sum(dtype=np.int64)
+    if edges.shape[0] > 0:
+        costs = pairwise[labels[edges[:, 0]], labels[edges[:, 1]]].astype(np.int64)
+        if edges.shape[1] > 2:
+            costs *= edges[:, 2]
+        e += costs.sum()
+    return e
+
+
+def solve_pygco(edges, unaries, pairwise, **kwargs):
+    # alpha-expansion by gco (the exact graph cut based solver)
+    import pygco
+    # gco needs int32 costs, compact unaries are converted here (for the nodes of the graph only)
+    unaries = np.ascontiguousarray(unaries, dtype=np.int32)
+    labels = pygco.cut_from_graph(edges, unaries, pairwise)
+    return SolverResult(labels, energy(edges, unaries, pairwise, labels), None)
+
+
+def _oriented_edges(edges, colors):
+    # edges oriented from the nodes of color 0 to the nodes of color 1 (the grid graph is bipartite)
+    a = edges[:, 0]
+    b = edges[:, 1]
+    if colors is None:
+        return a, b
+    swap = colors[a] != 0
+    return np.where(swap, b, a), np.where(swap, a, b)
+
+
+def _neighbour_sums(a, b, values, n_nodes, weights=None):
+    # sum of values (n_nodes, n_labels) of the neighbours b of the nodes a
+    n_labels = values.shape[1]
+    sums = np.empty((n_nodes, n_labels))
+    for k in range(n_labels):
+        w = values[b, k] if weights is None else values[b, k] * weights
+        sums[:, k] = np.bincount(a, weights=w, minlength=n_nodes)
+    return sums
+
+
+def _label_counts(a, b, labels, n_nodes, n_labels, weights=None):
+    # (weighted) number of the neighbours b with a given label of the nodes a
+    counts = np.bincount(a * n_labels + labels[b], weights=weights, minlength=n_nodes * n_labels)
+    return counts.reshape(n_nodes, n_labels)
+
+
+def solve_icm(edges, unaries, pairwise, colors=None, n_iter=20, tol=0, init=None, **kwargs):
+    '''
+    Iterated conditional modes with checkerboard updates.
+    Nodes of one color are updated simultaneously given the labels of the other color. For a grid graph colored by the
+    parity of the coordinates this is the exact sequential ICM. Without colors all the nodes are updated at once.
+    :param colors: (n_nodes,) colors 0/1 of the nodes or None
+    :param n_iter: maximal number of sweeps
+    :param tol: the iteration stops when at most this fraction of nodes changed its label in a sweep
+    :param init: initial labels, argmin of the unaries if None
+    '''
+    n_nodes, n_labels = unaries.shape
+    weights = edges[:, 2].astype(np.float64) if edges.shape[1] > 2 else None
+    a, b = _oriented_edges(edges, colors)
+    phases = [(a, b, colors == 0), (b, a, colors == 1)] if colors is not None else [(np.r_[a, b], np.r_[b, a], None)]
+    if weights is not None and colors is None:
+        weights = np.r_[weights, weights]
+    pairwise_t = pairwise.T.astype(np.float64)
+
+    labels = np.argmin(unaries, axis=1).astype(np.int32) if init is None else np.array(init, dtype=np.int32)
+    it = 0
+    for it in range(1, n_iter + 1):
+        n_changed = 0
+        for src, dst, sel in phases:
+            counts = _label_counts(src, dst, labels, n_nodes, n_labels, weights)
+            costs = unaries + counts.dot(pairwise_t)
+            new = np.argmin(costs, axis=1).astype(np.int32)
+            if sel is not None:
+                new = np.where(sel, new, labels)
+            n_changed += np.count_nonzero(new != labels)
+            labels = new
+        if n_changed <= tol * n_nodes:
+            break
+    return SolverResult(labels, energy(edges, unaries, pairwise, labels), it)
+
+
+def solve_mean_field(edges, unaries, pairwise, colors=None, n_iter=20, tol=1e-3, temperature=1., **kwargs):
+    '''
+    Mean-field approximation with checkerboard updates, the labels are the modes of the marginals.
+    :param colors: (n_nodes,) colors 0/1 of the nodes or None
+    :param n_iter: maximal number of sweeps
+    :param tol: the iteration stops when no marginal changed more than tol in a sweep
+    :param temperature: temperature of the Gibbs distribution
+    '''
+    n_nodes, n_labels = unaries.shape
+    weights = edges[:, 2].astype(np.float64) if edges.shape[1] > 2 else None
+    a, b = _oriented_edges(edges, colors)
+    phases = [(a, b, colors == 0), (b, a, colors == 1)] if colors is not None else [(np.r_[a, b], np.r_[b, a], None)]
+    if weights is not None and colors is None:
+        weights = np.r_[weights, weights]
+    pairwise_t = pairwise.T.astype(np.float64)
+
+    def marginals(costs):
+        q = np.exp(-(costs - costs.min(axis=1)[:, np.newaxis]) / temperature)
+        q /= q.sum(axis=1)[:, np.newaxis]
+        return q
+
+    q = marginals(unaries.astype(np.float64))
+    it = 0
+    for it in range(1, n_iter + 1):
+        delta = 0
+        for src, dst, sel in phases:
+            sums = _neighbour_sums(src, dst, q, n_nodes, weights)
+            new = marginals(unaries + sums.dot(pairwise_t))
+            if sel is not None:
+                new[~sel] = q[~sel]
+            delta = max(delta, np.abs(new - q).max() if n_nodes else 0)
+            q = new
+        if delta <= tol:
+            break
+    labels = np.argmax(q, axis=1).astype(np.int32)
+    return SolverResult(labels, energy(edges, unaries, pairwise, labels), it)
+
+
+def _grid_neighbours(inds, shape, mask):
+    # raveled indices of the in-mask grid neighbours of the voxels, pairs (voxel position, neighbour index)
+    coords = np.unravel_index(inds, shape)
+    strides = np.cumprod((1,) + tuple(shape[::-1]))[:-1][::-1]
+    pos_l = []
+    nb_l = []
+    for axis, stride in enumerate(strides):
+        for step in (-1, 1):
+            c = coords[axis] + step
+            valid = (c >= 0) & (c < shape[axis])
+            nb = inds[valid] + step * stride
+            valid_nb = mask.flat[nb] != 0
+            pos_l.append(np.flatnonzero(valid)[valid_nb])
+            nb_l.append(nb[valid_nb])
+    return np.concatenate(pos_l), np.concatenate(nb_l)
+
+
+def solve_icm_local(unary_rows, pairwise, labels, mask, active, n_iter=20):
+    '''
+    ICM restricted to a neighbourhood of a change of a grid labelling (e.g. of edited seeds).
+    Only the active voxels are updated in the first sweep and the neighbours of the changed voxels in the next ones,
+    so the cost is proportional to the size of the affected region and not to the size of the grid. The checkerboard
+    order of solve_icm is kept.
+    :param unary_rows: callable returning the (n, n_labels) unaries of the given raveled voxel indices
+    :param pairwise: (n_labels, n_labels) pairwise costs
+    :param labels: labels of the whole grid, updated in place (the voxels outside the mask are not touched)
+    :param mask: boolean (or nonzero-valued) array of the grid nodes
+    :param active: raveled indices of the voxels updated in the first sweep
+    :param n_iter: maximal number of sweeps
+    :return: (number of sweeps, number of changed voxels)
+    '''
+    pairwise_t = pairwise.T.astype(np.float64)
+    n_labels = pairwise.shape[0]
+    active = np.unique(active)
+    active = active[mask.flat[active] != 0]
+    n_total = 0
+    it = 0
+    for it in range(1, n_iter + 1):
+        changed_l = []
+        parity = grid_graph.node_parity(active, labels.shape)
+        for color in (0, 1):
+            sel = active[parity == color]
+            if sel.size == 0:
+                continue
+            pos, nb = _grid_neighbours(sel, labels.shape, mask)
+            counts = np.bincount(pos * n_labels + labels.flat[nb], minlength=sel.size * n_labels)
+            costs = unary_rows(sel) + counts.reshape(sel.size, n_labels).dot(pairwise_t)
+            new = np.argmin(costs, axis=1)
+            change = new != labels.flat[sel]
+            labels.flat[sel[change]] = new[change]
+            changed_l.append(sel[change])
+        changed = np.concatenate(changed_l) if changed_l else np.zeros(0, dtype=np.intp)
+        n_total += changed.size
+        if changed.size == 0:
+            break
+        _, nb = _grid_neighbours(changed, labels.shape, mask)
+        active = np.unique(np.r_[changed, nb])
+    return it, n_total
+
+
+SOLVERS = {
+    'pygco': solve_pygco,
+    'icm': solve_icm,
+    'mean_field': solve_mean_field,
+}
+
+
+def solve(edges, unaries, pairwise, method='pygco', **kwargs):
+    '''
+    Find a labelling minimizing the energy of a graph.
+    :param edges: (n_edges, 2) int32 node pairs, optionally with edge weights in the third column
+    :param unaries: (n_nodes, n_labels) int32 unary costs
+    :param pairwise: (n_labels, n_labels) int32 pairwise costs
+    :param method: 'pygco' (alpha-expansion), 'icm' or 'mean_field' (fast approximate NumPy solvers)
+    :param kwargs: parameters of the solver (colors, n_iter, tol, ...)
+    :return: SolverResult
+    '''
+    if method not in SOLVERS:
+        raise ValueError('Unknown solver: %s' % method)
+    if unaries.shape[0] == 0:
+        return SolverResult(np.zeros(0, dtype=np.int32), 0, 0)
+    return SOLVERS[method](edges, unaries, pairwise, **kwargs)
+
+
+def solve_grid(edges, unaries, pairwise, nodes, shape, method='pygco', n_iter=20, tol=0, colors=None, init=None):
+    '''
+    Solve a (masked) grid graph, the approximate solvers update the nodes in the checkerboard order of the grid.
+    :param nodes: raveled indices of the nodes in the grid
+    :param shape: shape of the grid
+    :param colors: precomputed checkerboard colors of the nodes, derived from the nodes if None
+    :param init: initial labels of the nodes (warm start of icm, ignored by the other solvers)
+    :return: SolverResult
+    '''
+    kwargs = dict()
+    if method != 'pygco':
+        if colors is None:
+            colors = grid_graph.node_parity(nodes, shape)
+        kwargs = {'colors': colors, 'n_iter': n_iter, 'tol': tol, 'init': init}
+    return solve(edges, unaries, pairwise, method=method, **kwargs)
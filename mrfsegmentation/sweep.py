@@ -0,0 +1,258 @@
+__author__ = 'tomas'
+
+import itertools
+import multiprocessing
+import time
+from collections import namedtuple
+
+import concurrent.futures as confut
+
+import grid_graph
+import solvers
+from markov_random_field import MarkovRandomField
+# the stage dependencies are shared with the disk cache
+from result_cache import STAGE_PARAMS, STAGE_DEPENDENCIES, stage_key
+
+# result of one combination of the parameters - times of the stages in seconds, reused lists the stages taken from
+# the results of another combination (their times are those of the original computation)
+SweepResult = namedtuple('SweepResult', ['params', 'labels', 'energy', 'times', 'reused'])
+
+
+def param_grid(grid):
+    '''
+    All the combinations of the parameter values.
+    :param grid: dict {name: list of values} or list of (name, values) pairs
+    :return: list of dicts {name: value}
+    '''
+    items = sorted(grid.items()) if isinstance(grid, dict) else list(grid)
+    names = [name for name, _ in items]
+    return [dict(zip(names, values)) for values in itertools.product(*[list(v) for _, v in items])]
+
+
+class SweepResults():
+    '''
+    Results of a parameter sweep in the order of the combinations.
+    '''
+
+    def __init__(self, names, results):
+        self.names = names  # names of the swept parameters
+        self.results = results
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __getitem__(self, item):
+        return self.results[item]
+
+    def get(self, **params):
+        '''
+        Result of the combination with the given values of the swept parameters.
+        '''
+        for res in self.results:
+            if all(res.params[k] == v for k, v in params.items()):
+                return res
+        raise KeyError('No combination of %s.' % params)
+
+    def table(self):
+        '''
+        One row per combination - the swept parameters, the energy and the times of the stages.
+        :return: list of dicts
+        '''
+        rows = []
+        for res in self.results:
+            row = dict((k, res.params[k]) for k in self.names)
+            row['energy'] = res.energy
+            row.update(('time_%s' % k, v) for k, v in res.times.items())
+            rows.append(row)
+        return rows
+
+    def __str__(self):
+        lines = []
+        for res in self.results:
+            params = ', '.join('%s=%s' % (k, res.params[k]) for k in self.names)
+            total = sum(res.times.values())
+            lines.append('%s: energy = %s, time = %.3f s, reused = %s' % (params, res.energy, total,
+                                                                          ', '.join(res.reused) or '-'))
+        return '\n'.join(lines)
+
+
+def _solve_combo(i, edges, unaries, pairwise, nodes, shape, solver, n_iter, tol):
+    # runs in a worker, the labels of the nodes are returned together with the energy and the time of the solver
+    t_start = time.time()
+    result = solvers.solve_grid(edges, unaries, pairwise, nodes, shape, method=solver, n_iter=n_iter, tol=tol)
+    return i, result.labels, result.energy, time.time() - t_start
+
+
+class _StageCache():
+    # results of the stages keyed by stage_key, with the time of their computation
+
+    def __init__(self):
+        self.values = dict()
+
+    def get(self, stage, params, compute):
+        key = (stage, stage_key(stage, params))
+        reused = key in self.values
+        if not reused:
+            t_start = time.time()
+            value = compute()
+            self.values[key] = (value, time.time() - t_start)
+        value, t = self.values[key]
+        return value, t, reused
+
+    def release(self, stage, keep):
+        # drop the results of a stage not used by the remaining combinations
+        for key in list(self.values):
+            if key[0] == stage and key[1] not in keep:
+                del self.values[key]
+
+
+def _configure(mrf, params):
+    # switch a field to the parameters of a combination
+    mrf.params = params
+    mrf.alpha = params['alpha']
+    mrf.beta = params['beta']
+    mrf.scale = params['scale']
+
+
+def sweep(img, grid, seeds=None, mask=None, n_objects=2, models_estim=None, params=None, config_path='config.ini',
+          max_workers=None, executor='thread', keep_labels=True, verbose=False):
+    '''
+    Segment an image for all the combinations of a grid of parameter values.
+    Every stage (rescaling, intensity models, unaries, edges, pairwise term) is computed only once per distinct value
+    of the parameters it depends on (see STAGE_PARAMS) and shared by all the combinations agreeing in them, e.g. the
+    combinations differing in alpha only share everything except the pairwise term and the solution. The graph cuts
+    are solved in parallel.
+    :param img: input image
+    :param grid: dict {name: list of values} of the swept parameters (alpha, beta, k_std_dom, prob_w, scale, ...)
+    :param params: common parameters, loaded from config_path if not given
+    :param max_workers: number of workers solving the graph cuts, defaults to the number of cpus
+    :param executor: 'thread' or 'process' pool of the workers
+    :param keep_labels: if to keep the labels of the combinations, only the energies and times are kept otherwise
+    :return: SweepResults
+    '''
+    if params is None:
+        params = MarkovRandomField.load_parameters(config_path)
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    names = [name for name, _ in (sorted(grid.items()) if isinstance(grid, dict) else grid)]
+    combos = []
+    for combo in param_grid(grid):
+        p = dict(params)
+        p.update(combo)
+        combos.append(p)
+    # combinations sharing the unaries are solved together so that only the unaries in use are kept in memory
+    order = sorted(range(len(combos)), key=lambda i: (stage_key('unaries', combos[i]), i))
+
+    cache = _StageCache()
+
+    def field(p):
+        def compute():
+            mrf = MarkovRandomField(img, seeds, n_objects=n_objects, mask=mask, alpha=p['alpha'], beta=p['beta'],
+                                    scale=p['scale'], models_estim=models_estim, verbose=verbose, params=p)
+            mrf._rescale_input(True)
+            return mrf
+        return cache.get('input', p, compute)
+
+    results = [None] * len(combos)
+    times = [None] * len(combos)
+    reused = [None] * len(combos)
+    nodes_of = [None] * len(combos)
+    fields_of = [None] * len(combos)
+
+    def finish(future):
+        i, labels, energy, t_solve = future.result()
+        times[i]['solve'] = t_solve
+        p = combos[i]
+        labels_out = None
+        if keep_labels:
+            mrf = fields_of[i]
+            mrf.labels = grid_graph.scatter_labels(labels, nodes_of[i], mrf.img.shape, bgd_label=mrf.get_bgd_label(),
+                                                   dtype=labels.dtype)
+            t_start = time.time()
+            mrf._rescale_labels(True)
+            labels_out = mrf.labels_orig
+            times[i]['rescale_labels'] = time.time() - t_start
+        results[i] = SweepResult(dict((k, p[k]) for k in names), labels_out, energy, times[i], tuple(reused[i]))
+
+    pool_class = confut.ProcessPoolExecutor if executor == 'process' else confut.ThreadPoolExecutor
+    with pool_class(max_workers=max_workers) as pool:
+        pending = set()
+        unaries_key = None
+        for i in order:
+            p = combos[i]
+            mrf, t_input, r_input = field(p)
+            _configure(mrf, p)
+            times[i] = {'input': t_input}
+            reused[i] = ['input'] if r_input else []
+
+            def stage(name, compute):
+                value, t, r = cache.get(name, p, compute)
+                times[i][name] = t
+                if r:
+                    reused[i].append(name)
+                return value
+
+            key = stage_key('unaries', p)
+            if key != unaries_key:
+                # the unaries of the previous group are no longer needed
+                cache.release('unaries', [key])
+                unaries_key = key
+
+            models = stage('models', mrf.calc_models)
+            mrf.models = models
+            n_obj = len(models)
+            edges, nodes = stage('edges', lambda: grid_graph.masked_grid_edges(mrf.mask))
+
+            def compute_unaries():
+                if mrf.lean:
+                    unaries = mrf.get_unaries_compact()
+                else:
+                    unaries = mrf.beta * mrf.get_unaries()
+                # only the unaries of the graph nodes are kept
+                return unaries.reshape(-1, n_obj)[nodes, :]
+            unaries = stage('unaries', compute_unaries)
+
+            def compute_pairwise():
+                mrf.n_objects = n_obj
+                mrf.set_pairwise()
+                return mrf.pairwise
+            pairwise = stage('pairwise', compute_pairwise)
+
+            nodes_of[i] = nodes
+            fields_of[i] = mrf
+            # at most two combinations per worker are submitted at once, the submitted ones hold their unaries
+            while len(pending) >= 2 * max_workers:
+                done, pending = confut.wait(pending, return_when=confut.FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+            pending.add(pool.submit(_solve_combo, i, edges, unaries, pairwise, nodes, mrf.img.shape, p['solver'],
+                                    p['solver_iter'], p['solver_tol']))
+
+        for future in confut.as_completed(pending):
+            finish(future)
+
+    return SweepResults(names, results)
+
+
+def verify(results, img, seeds=None, mask=None, n_objects=2, models_estim=None, params=None, config_path='config.ini'):
+    '''
+    Check a sweep against standalone segmentations - every combination is segmented by MarkovRandomField.run with the
+    same parameters, no stage is shared.
+    :param results: SweepResults of sweep called with the same image and arguments
+    :return: list of the indices of the combinations whose energy (or labels, if they were kept) differ
+    '''
+    if params is None:
+        params = MarkovRandomField.load_parameters(config_path)
+    mismatches = []
+    for i, res in enumerate(results):
+        p = dict(params)
+        p.update(res.params)
+        mrf = MarkovRandomField(img, seeds, n_objects=n_objects, mask=mask, alpha=p['alpha'], beta=p['beta'],
+                                scale=p['scale'], models_estim=models_estim, verbose=False, params=p)
+        labels = mrf.run()
+        if mrf.energy != res.energy or (res.labels is not None and not (labels == res.labels).all()):
+            mismatches.append(i)
+    return mismatches
@@ -0,0 +1,53 @@
+__author__ = 'tomas'
+
+import numpy as np
+
+
+def slab_ranges(n_slices, tile_size, halo=0):
+    '''
+    Split the slice axis into overlapping slabs.
+    :param n_slices: number of slices of the volume
+    :param tile_size: number of slices of the core region of every slab
+    :param halo: number of slices added on both sides of the core region (clipped at the volume borders)
+    :return: list of tuples (start, stop, core_start, core_stop) - the slab is [start, stop), its core region is
+             [core_start, core_stop) in volume coordinates
+    '''
+    if tile_size < 1:
+        raise ValueError('Tile size has to be positive.')
+    if halo < 0:
+        raise ValueError('Halo width cannot be negative.')
+    ranges = []
+    for core_start in range(0, n_slices, tile_size):
+        core_stop = min(core_start + tile_size, n_slices)
+        start = max(0, core_start - halo)
+        stop = min(n_slices, core_stop + halo)
+        ranges.append((start, stop, core_start, core_stop))
+    return ranges
+
+
+def bounding_box(data, margin=0):
+    '''
+    Bounding box of the nonzero voxels.
+    :param data: array (e.g. a mask or seeds), can be a np.memmap
+    :param margin: number of voxels added on every side (clipped at the array borders)
+    :return: tuple of slices, None if there is no nonzero voxel
+    '''
+    box = []
+    for axis in range(data.ndim):
+        other = tuple(a for a in range(data.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(data, axis=other))
+        if nonzero.size == 0:
+            return None
+        box.append(slice(max(0, nonzero[0] - margin), min(data.shape[axis], nonzero[-1] + 1 + margin)))
+    return tuple(box)
+
+
+def union_box(box_a, box_b):
+    '''
+    Smallest box containing both boxes, None boxes are ignored.
+    '''
+    if box_a is None:
+        return box_b
+    if box_b is None:
+        return box_a
+    return tuple(slice(min(a.start, b.start), max(a.stop, b.stop)) for a, b in zip(box_a, box_b))
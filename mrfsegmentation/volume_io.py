@@ -0,0 +1,159 @@
+from __future__ import division
+
+__author__ = 'tomas'
+
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+# size of the fixed part of a zip local file header
+_ZIP_LOCAL_HEADER = 30
+
+# bit widths of the packed labels
+PACK_BITS = (1, 2, 4, 8)
+
+
+def _npz_memmap(path, member):
+    # memory map of an uncompressed member of an .npz archive, None if the member is compressed
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(member)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, 'rb') as f:
+        f.seek(info.header_offset)
+        header = f.read(_ZIP_LOCAL_HEADER)
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + _ZIP_LOCAL_HEADER + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        return None
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+def load_volume(path, key=None, shape=None, dtype=None, mmap=True):
+    '''
+    Open a volume without loading it - .npy files and uncompressed .npz members are memory-mapped, raw files are
+    memory-mapped with the given shape and dtype. Compressed .npz members are loaded.
+    :param path: path to a .npy, .npz or raw file
+    :param key: member of an .npz archive, defaults to the first one
+    :param shape: shape of a raw volume
+    :param dtype: dtype of a raw volume
+    :param mmap: if to memory-map the data, the data are loaded otherwise
+    :return: array or np.memmap
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return np.load(path, mmap_mode='r' if mmap else None)
+    elif ext == '.npz':
+        with np.load(path) as archive:
+            if key is None:
+                key = archive.files[0]
+            elif key not in archive.files:
+                raise KeyError('%s has no member %s' % (path, key))
+            data = _npz_memmap(path, key + '.npy') if mmap else None
+            if data is None:
+                data = archive[key]
+        return data
+    if shape is None or dtype is None:
+        raise ValueError('Raw volume %s needs a shape and a dtype.' % path)
+    if mmap:
+        return np.memmap(path, dtype=dtype, mode='r', shape=tuple(shape))
+    return np.fromfile(path, dtype=dtype).reshape(shape)
+
+
+def label_bits(max_label):
+    '''
+    Smallest bit width of PACK_BITS holding the labels 0 .. max_label, None if 8 bits are not enough.
+    '''
+    for bits in PACK_BITS:
+        if max_label < 2 ** bits:
+            return bits
+    return None
+
+
+def pack_labels(labels, bits):
+    '''
+    Pack labels into bytes, 8 // bits labels per byte (e.g. 4 labels of n_objects <= 4 per byte).
+    :param labels: non-negative labels smaller than 2 ** bits
+    :param bits: 1, 2, 4 or 8
+    :return: uint8 array of ceil(labels.size * bits / 8) bytes
+    '''
+    per_byte = 8 // bits
+    flat = np.asarray(labels).ravel()
+    n = flat.size
+    padded = np.zeros(-(-n // per_byte) * per_byte, dtype=np.uint8)
+    padded[:n] = flat
+    groups = padded.reshape(-1, per_byte)
+    packed = np.zeros(groups.shape[0], dtype=np.uint8)
+    for i in range(per_byte):
+        packed |= groups[:, i] << (bits * i)
+    return packed
+
+
+def unpack_labels(packed, bits, shape):
+    '''
+    Inverse of pack_labels.
+    :return: uint8 labels of the given shape
+    '''
+    per_byte = 8 // bits
+    mask = 2 ** bits - 1
+    groups = np.empty((packed.size, per_byte), dtype=np.uint8)
+    for i in range(per_byte):
+        groups[:, i] = (packed >> (bits * i)) & mask
+    return groups.ravel()[:int(np.prod(shape))].reshape(shape)
+
+
+def save_labels(path, labels, fmt='packed'):
+    '''
+    Write labels to disk.
+    :param path: output path without extension, '.npz' (packed) or '.npy' (memmap) is appended
+    :param labels: label volume
+    :param fmt: 'packed' - compressed .npz with the labels bit-packed into the smallest sufficient width,
+                'memmap' - .npy file written through a memory map in the smallest sufficient integer dtype
+    :return: path of the written file
+    '''
+    labels = np.asarray(labels)
+    max_label = int(labels.max()) if labels.size else 0
+    if labels.size and labels.min() < 0:
+        raise ValueError('Only non-negative labels can be saved.')
+    if fmt == 'packed':
+        bits = label_bits(max_label)
+        path += '.npz'
+        if bits is None:
+            np.savez_compressed(path, labels=labels, shape=np.array(labels.shape), bits=np.array(0))
+        else:
+            np.savez_compressed(path, packed=pack_labels(labels, bits), shape=np.array(labels.shape),
+                                bits=np.array(bits))
+    elif fmt == 'memmap':
+        path += '.npy'
+        dtype = np.uint8 if max_label < 2 ** 8 else (np.uint16 if max_label < 2 ** 16 else np.int32)
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=labels.shape)
+        # written slice by slice so that no full-size converted copy is made
+        for i in range(labels.shape[0]):
+            out[i] = labels[i]
+        out.flush()
+        del out
+    else:
+        raise ValueError('Unknown label format: %s' % fmt)
+    return path
+
+
+def load_labels(path):
+    '''
+    Read labels written by save_labels.
+    :return: label volume (memory-mapped for the .npy format)
+    '''
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    with np.load(path) as archive:
+        bits = int(archive['bits'])
+        if bits == 0:
+            return archive['labels']
+        return unpack_labels(archive['packed'], bits, tuple(archive['shape']))